@@ -0,0 +1,756 @@
+from .cache import CachedCursor, ResultCache
+from .configuration import Configuration, PoolTimeoutException
+from .database import CursorWrapper, Database, Loader, QueryTimeoutException, SelectBuilder
+from .instrumentation import Instrumentation, logger
+
+import asyncio
+import collections
+import os
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import time
+import uuid
+
+
+class AsyncDatabase(Database):
+
+    """
+    Asynchronous facade to access database
+    """
+
+    connection = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        timeout = self.configuration.pool_options['timeout']
+        if self.deadline is not None:
+            timeout = self.remaining(timeout)
+        try:
+            try:
+                self.connection = await asyncio.wait_for(self.pool.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise PoolTimeoutException('No connection was released in {:g} seconds'.format(timeout))
+        except Exception as exception:
+            self.instrumentation.checkout(time.perf_counter() - start, exception)
+            raise
+        self.instrumentation.checkout(time.perf_counter() - start)
+        try:
+            await self.send(self.connection.cursor(), 'begin')
+        except BaseException:
+            self.disconnect()
+            raise
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        try:
+            if not self.broken:
+                if exception_type is None and exception_value is None and exception_traceback is None:
+                    await self.send(self.connection.cursor(), 'commit')
+                    self.configuration.result_cache.invalidate(self.invalidated)
+                else:
+                    await self.send(self.connection.cursor(), 'rollback')
+        except BaseException:
+            self.broken = True
+            raise
+        finally:
+            self.invalidated = set()
+            self.loaders = {}
+            self.statement_timeouts = {}
+            self.disconnect()
+
+    def __enter__(self):
+        raise TypeError('AsyncDatabase must be used with async with')
+
+    def __init__(self, configuration=None, timeout=None):
+        self.broken = False
+        self.configuration = Configuration.instance() if configuration is None else configuration
+        self.connection = None
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.deferred = False
+        self.deferred_statements = []
+        self.instrumentation = self.configuration.instrumentation
+        self.invalidated = set()
+        self.loaders = {}
+        self.lock = asyncio.Lock()
+        self.pool = AsyncConnectionPool.instance(self.configuration)
+        self.prepared_statements = 0
+        self.print_sql = self.configuration.print_sql
+        self.statement_timeouts = {}
+        self.timeout = timeout
+
+    def copy_in(self, table, rows, columns=None, format='text', buffer_size=65536):
+        """
+        Copy is not supported by asynchronous connections
+        """
+        raise NotImplementedError('Copy is not supported by asynchronous connections')
+
+    def copy_out(self, sql, parameters=None, sink=None, format='csv', header=True, skip_load_query=False, buffer_size=65536, replica=None):
+        """
+        Copy is not supported by asynchronous connections
+        """
+        raise NotImplementedError('Copy is not supported by asynchronous connections')
+
+    def disconnect(self):
+        """
+        Return the connection to the pool, closing it when it is broken
+        :return: None
+        """
+        if self.connection is not None:
+            self.pool.release(self.connection, self.broken)
+            self.connection = None
+
+    async def execute(self, sql, parameters=None, skip_load_query=False, replica=None, cache=None, tags=None, row_format='wrapper', timeout=None, prepare=False):
+        """
+        Execute query by name
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param skip_load_query: Skip load file
+        :param replica: Not supported by asynchronous connections, always executed in the primary
+        :param cache: Cache the rows, True for the default TTL or the TTL in seconds
+        :param tags: Tables read by the query, its cached rows are invalidated when they are written
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :param timeout: Time limit in seconds, bounded by the timeout of the database
+        :param prepare: Not supported by asynchronous connections, never prepared
+        :return: Cursor
+        """
+        cursor_factory = Database.cursor_factory(row_format)
+        if self.print_sql:
+            logger.info('Query: %s - Parameters: %s', sql, parameters)
+        key = sql
+        if skip_load_query:
+            sql = sql
+        else:
+            sql = self.load_query(sql)
+        cache_key = None
+        if cache and self.invalidated.isdisjoint(ResultCache.tag(tag) for tag in tags or ()):
+            cache_key = ResultCache.key(sql, parameters, cursor_factory is not None)
+            cursor = self.configuration.result_cache.get(cache_key)
+            if cursor is not None:
+                return AsyncCursorWrapper(cursor, row_format=row_format)
+        statement_timeout = self.timeout if timeout is None else timeout
+        timeout = self.remaining(timeout)
+        cursor = self.connection.cursor(cursor_factory=cursor_factory)
+        prefix = self.statement_timeout(self.connection, statement_timeout)
+        start = time.perf_counter()
+        try:
+            try:
+                await asyncio.wait_for(self.send(cursor, prefix + sql, parameters), timeout)
+            except asyncio.TimeoutError:
+                raise QueryTimeoutException('Query did not finish in {:g} seconds'.format(timeout))
+        except Exception as exception:
+            self.instrumentation.query(Instrumentation.shape(key), time.perf_counter() - start, None, exception, sql, parameters)
+            if timeout is not None and isinstance(exception, psycopg2.errors.QueryCanceled) and not isinstance(exception, QueryTimeoutException):
+                raise QueryTimeoutException('Query did not finish in {:g} seconds'.format(timeout)) from exception
+            raise
+        self.instrumentation.query(Instrumentation.shape(key), time.perf_counter() - start, cursor.rowcount, None, sql, parameters)
+        if cache_key is not None:
+            rows = cursor.fetchall()
+            cursor.close()
+            self.configuration.result_cache.set(cache_key, rows, tags or (), None if cache is True else cache, cursor.description)
+            return AsyncCursorWrapper(CachedCursor(rows, cursor.description), row_format=row_format)
+        return AsyncCursorWrapper(cursor, row_format=row_format)
+
+    def gather(self, queries, workers=None, timeout=None):
+        """
+        Gather is not supported by asynchronous connections, asyncio.gather runs several facades concurrently
+        """
+        raise NotImplementedError('Gather is not supported by asynchronous connections, use asyncio.gather')
+
+    def listen(self, *channels, reconnect_delay=1.0, on_reconnect=None):
+        """
+        Asynchronous subscription to notification channels in a dedicated connection, opened with async with
+        :param channels: Channel names
+        :param reconnect_delay: Seconds waited before opening the connection again when it is lost
+        :param on_reconnect: Function or coroutine function called with the subscription after the connection was opened
+        again, as the notifications sent meanwhile were lost
+        :return: Asynchronous subscription
+        """
+        return AsyncSubscription(self.configuration, channels, reconnect_delay, on_reconnect)
+
+    def loader(self, table, key='id', many=False, batch_size=1000, window=0):
+        """
+        Asynchronous loader of rows by key, the same loader is returned for the same select and key until the end of the
+        transaction
+        :param table: Table name or select builder
+        :param key: Key field
+        :param many: Load the list of rows of each key, else one row
+        :param batch_size: Maximum number of keys by query
+        :param window: Seconds waited for other keys before the query, by default the keys requested in the same
+        iteration of the event loop
+        :return: Asynchronous loader
+        """
+        builder = table if isinstance(table, SelectBuilder) else self.select(table)
+        name = (builder.sql(), ResultCache.freeze(builder.parameters), key, many)
+        if name not in self.loaders:
+            self.loaders[name] = AsyncLoader(builder, key, many, batch_size, window)
+        return self.loaders[name]
+
+    async def notify(self, channel, payload=None):
+        """
+        Notify a channel, the notification is delivered to the listeners when the transaction is committed
+        :param channel: Channel name
+        :param payload: Payload string, or a dict or list encoded in JSON
+        :return: Cursor
+        """
+        return await self.execute(*Database.notify_statement(channel, payload), True, False)
+
+    async def notify_after(self, result, notifications):
+        """
+        Notify the channels of a builder after its execution
+        :param result: Awaitable result of the execution
+        :param notifications: List of channel and payload
+        :return: Result of the execution
+        """
+        result = await result
+        for channel, payload in notifications:
+            await self.notify(channel, payload)
+        return result
+
+    async def run(self, statements, replica=None, timeout=None, prepare=False):
+        """
+        Run the statements of a generator, sending back the cursor of each one
+        :param statements: Generator of SQL strings and parameters
+        :param replica: Not supported by asynchronous connections, always executed in the primary
+        :param timeout: Time limit in seconds for all the statements
+        :param prepare: Not supported by asynchronous connections, never prepared
+        :return: Return of the generator
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            sql, parameters = next(statements)
+            while True:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                sql, parameters = statements.send(await self.execute(sql, parameters, True, replica, timeout=timeout))
+        except StopIteration as stop:
+            return stop.value
+
+    def select(self, table):
+        """
+        Select string command
+        :param table: Table name
+        :return: Select builder
+        """
+        return AsyncSelectBuilder(self, table)
+
+    async def send(self, cursor, sql, parameters=None):
+        """
+        Send a statement and wait for its result, one at a time by connection, a cancelled statement is cancelled in the
+        server
+        :param cursor: Cursor
+        :param sql: SQL string
+        :param parameters: SQL parameters
+        :return: None
+        """
+        try:
+            async with self.lock:
+                cursor.execute(sql, parameters)
+                await AsyncConnectionPool.poll(self.connection)
+        except asyncio.CancelledError:
+            self.broken = True
+            self.connection.cancel()
+            raise
+
+    async def stream(self, sql, parameters=None, chunk_size=1000, skip_load_query=False, replica=None, row_format='wrapper'):
+        """
+        Execute query by name with a server-side cursor, fetching the rows in chunks
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param chunk_size: Number of rows fetched from the server at once
+        :param skip_load_query: Skip load file
+        :param replica: Not supported by asynchronous connections, always executed in the primary
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :return: Asynchronous generator of rows
+        """
+        Database.cursor_factory(row_format)
+        name = 'py_postgresql_wrapper_{}'.format(uuid.uuid4().hex)
+        if skip_load_query:
+            sql = sql
+        else:
+            sql = self.load_query(sql)
+        await self.execute('declare {} no scroll cursor for {}'.format(name, sql), parameters, True)
+        while True:
+            data = (await self.execute('fetch forward {} from {}'.format(chunk_size, name), None, True, row_format=row_format)).fetch_all()
+            if len(data) == 0:
+                break
+            for row in data:
+                yield row
+        await self.execute('close {}'.format(name), None, True)
+
+    def upsert(self, table, rows, conflict, update=None, threshold=1000, batch_size=1000):
+        """
+        Upsert is not supported by asynchronous connections, as it may copy the rows
+        """
+        raise NotImplementedError('Upsert is not supported by asynchronous connections')
+
+
+class AsyncLoader(Loader):
+
+    """
+    Asynchronous loader of rows by key, the keys requested in the same batch window are selected together in one query
+    and the loaded rows are memoized
+    """
+
+    def __init__(self, builder, key='id', many=False, batch_size=1000, window=0):
+        super(AsyncLoader, self).__init__(builder, key, many, batch_size)
+        self.task = None
+        self.window = window
+
+    async def dispatch(self):
+        """
+        Select the keys requested in the batch window, resolving the future of each one
+        :return: None
+        """
+        await asyncio.sleep(self.window)
+        futures = self.pending
+        self.task = None
+        try:
+            await self.builder.database.run(self.statements())
+        except Exception as exception:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(exception)
+            return
+        for key, future in futures.items():
+            if not future.done():
+                future.set_result(self.rows.get(key, [] if self.many else None))
+
+    async def get(self, key):
+        """
+        Get the rows of a key
+        :param key: Key
+        :return: Row or list of rows, None or empty list when not found
+        """
+        return await self.load(key)
+
+    async def load(self, key):
+        """
+        Load the rows of a key, selected with the other keys requested in the batch window
+        :param key: Key
+        :return: Row or list of rows, None or empty list when not found
+        """
+        if key in self.rows and key not in self.pending:
+            return self.rows[key]
+        future = self.pending.get(key)
+        if future is None:
+            future = self.pending[key] = asyncio.get_running_loop().create_future()
+            if self.task is None:
+                self.task = asyncio.ensure_future(self.dispatch())
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys):
+        """
+        Load the rows of keys in one query
+        :param keys: Keys
+        :return: List of rows or lists of rows, in the order of the keys
+        """
+        return list(await asyncio.gather(*[self.load(key) for key in keys]))
+
+    def prime(self, key, rows):
+        """
+        Set the rows of a key, without selecting it
+        :param key: Key
+        :param rows: Row or list of rows
+        :return: None
+        """
+        future = self.pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(rows)
+        self.rows[key] = rows
+
+
+class AsyncSelectBuilder(SelectBuilder):
+
+    """
+    Select builder of an asynchronous database, the operations requiring synchronous connections are not supported
+    """
+
+    def scan(self, partitions=4, key=None, ordered=False, chunk_size=1000, function=None, processes=None, queue_size=4, workers=None):
+        """
+        Scan is not supported by asynchronous connections, as each partition is streamed in a thread with a pooled connection
+        """
+        raise NotImplementedError('Scan is not supported by asynchronous connections')
+
+
+class AsyncConnectionPool(object):
+
+    """
+    Pool of asynchronous connections, serving the waiters in arrival order
+    """
+
+    def __init__(self, size, **data):
+        self.data = data
+        self.idle = []
+        self.opened = 0
+        self.size = size
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        """
+        Acquire a connection, waiting for one when the pool is full
+        :return: Connection
+        """
+        if len(self.idle) > 0:
+            return self.idle.pop()
+        if self.opened < self.size:
+            return await self.connect()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result())
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+
+    def close(self):
+        """
+        Close the idle connections
+        :return: None
+        """
+        while len(self.idle) > 0:
+            self.idle.pop().close()
+            self.opened -= 1
+
+    async def connect(self):
+        """
+        Open a new connection
+        :return: Connection
+        """
+        self.opened += 1
+        try:
+            connection = psycopg2.connect(async_=True, **self.data)
+            await AsyncConnectionPool.poll(connection)
+            return connection
+        except BaseException:
+            self.opened -= 1
+            raise
+
+    def detach(self):
+        """
+        Detach the idle connections inherited from the parent process, redirecting their sockets to /dev/null before
+        closing them so that the connections of the parent are not terminated
+        :return: None
+        """
+        null = os.open(os.devnull, os.O_RDWR)
+        try:
+            while len(self.idle) > 0:
+                connection = self.idle.pop()
+                if not connection.closed:
+                    os.dup2(null, connection.fileno())
+                    connection.close()
+        finally:
+            os.close(null)
+        self.waiters.clear()
+
+    @staticmethod
+    def instance(configuration):
+        """
+        Get the asynchronous pool of a configuration, created again in a forked process
+        :param configuration: Configuration
+        :return: Asynchronous pool instance
+        """
+        if configuration.pid != os.getpid():
+            configuration.fork()
+        if configuration.async_pool is None:
+            data = dict(configuration.data)
+            configuration.async_pool = AsyncConnectionPool(data.pop('maxconnections'), **data)
+        return configuration.async_pool
+
+    @staticmethod
+    async def poll(connection):
+        """
+        Wait for the connection to be ready, without blocking the event loop
+        :param connection: Connection
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            state = connection.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            future = loop.create_future()
+
+            def ready():
+                if not future.done():
+                    future.set_result(None)
+
+            if state == psycopg2.extensions.POLL_READ:
+                loop.add_reader(connection.fileno(), ready)
+                try:
+                    await future
+                finally:
+                    loop.remove_reader(connection.fileno())
+            elif state == psycopg2.extensions.POLL_WRITE:
+                loop.add_writer(connection.fileno(), ready)
+                try:
+                    await future
+                finally:
+                    loop.remove_writer(connection.fileno())
+            else:
+                raise psycopg2.OperationalError('{} is not a valid poll state'.format(state))
+
+    async def replace(self):
+        """
+        Open a connection for the first waiter, after a broken connection was closed
+        :return: None
+        """
+        if len(self.waiters) == 0 or self.opened >= self.size:
+            return
+        try:
+            connection = await self.connect()
+        except Exception as exception:
+            while len(self.waiters) > 0:
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_exception(exception)
+                    return
+            return
+        self.release(connection)
+
+    def release(self, connection, discard=False):
+        """
+        Release a connection, handing it to the first waiter
+        :param connection: Connection
+        :param discard: Close the connection
+        :return: None
+        """
+        if discard or connection.closed:
+            connection.close()
+            self.opened -= 1
+            if len(self.waiters) > 0:
+                asyncio.ensure_future(self.replace())
+            return
+        while len(self.waiters) > 0:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+        self.idle.append(connection)
+
+
+# Wrappers
+class AsyncCursorWrapper(CursorWrapper):
+
+    """
+    Cursor wrapper with asynchronous iteration
+    """
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return self.next()
+        except StopIteration:
+            raise StopAsyncIteration()
+
+
+# Streams
+class AsyncSubscription(object):
+
+    """
+    Subscription to notification channels in a dedicated asynchronous connection, read by the event loop when the
+    socket is readable and listening again on the channels when the connection is lost
+    """
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        notification = await self.get()
+        if notification is None:
+            raise StopAsyncIteration()
+        return notification
+
+    def __init__(self, configuration, channels, reconnect_delay=1.0, on_reconnect=None):
+        self.channels = list(channels)
+        self.closed = False
+        self.configuration = configuration
+        self.connection = None
+        self.fileno = None
+        self.notifications = asyncio.Queue()
+        self.on_reconnect = on_reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnecting = None
+        self.reconnects = 0
+
+    async def batches(self, window=0.01, max_size=1000):
+        """
+        Asynchronous generator of the notifications in bursts, each batch waits up to the window after its first
+        notification
+        :param window: Seconds waited for other notifications
+        :param max_size: Maximum number of notifications by batch
+        :return: Asynchronous generator of lists of notifications, until the subscription is closed
+        """
+        while True:
+            notification = await self.get()
+            if notification is None:
+                return
+            batch = [notification]
+            deadline = time.monotonic() + window
+            while len(batch) < max_size:
+                notification = await self.get(max(0, deadline - time.monotonic()))
+                if notification is None:
+                    break
+                batch.append(notification)
+            yield batch
+
+    def close(self):
+        """
+        Close the connection, stopping the iteration
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        self.disconnect()
+        self.notifications.put_nowait(None)
+
+    async def command(self, command, channels):
+        """
+        Execute listen or unlisten on channels, without reading the connection meanwhile
+        :param command: listen or unlisten
+        :param channels: Channel names
+        :return: None
+        """
+        if self.connection is None or len(channels) == 0:
+            return
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.fileno)
+        try:
+            for channel in channels:
+                await AsyncSubscription.send(self.connection, '{} {}'.format(command, psycopg2.extensions.quote_ident(channel, self.connection)))
+        finally:
+            if self.connection is not None and not self.connection.closed:
+                loop.add_reader(self.fileno, self.read)
+        self.read()
+
+    async def connect(self):
+        """
+        Open the connection and listen on the channels
+        :return: None
+        """
+        data = dict(self.configuration.data)
+        data.pop('maxconnections')
+        connection = psycopg2.connect(async_=True, **data)
+        try:
+            await AsyncConnectionPool.poll(connection)
+            for channel in self.channels:
+                await AsyncSubscription.send(connection, 'listen {}'.format(psycopg2.extensions.quote_ident(channel, connection)))
+        except BaseException:
+            connection.close()
+            raise
+        self.connection = connection
+        self.fileno = connection.fileno()
+        asyncio.get_running_loop().add_reader(self.fileno, self.read)
+        self.read()
+
+    def disconnect(self):
+        """
+        Stop reading and close the connection
+        :return: None
+        """
+        if self.connection is not None:
+            asyncio.get_running_loop().remove_reader(self.fileno)
+            self.connection.close()
+            self.connection = None
+
+    async def get(self, timeout=None):
+        """
+        Next notification, waiting for it
+        :param timeout: Seconds waited, by default until a notification arrives or the subscription is closed
+        :return: Notification with channel, payload and pid, None when the timeout expired or the subscription was closed
+        """
+        if not self.notifications.empty():
+            notification = self.notifications.get_nowait()
+        elif timeout is not None and timeout <= 0:
+            return None
+        else:
+            try:
+                notification = await asyncio.wait_for(self.notifications.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if notification is None:
+            self.notifications.put_nowait(None)
+        return notification
+
+    async def listen(self, *channels):
+        """
+        Listen on other channels
+        :param channels: Channel names
+        :return: Self
+        """
+        await self.command('listen', [channel for channel in channels if channel not in self.channels])
+        self.channels.extend(channel for channel in channels if channel not in self.channels)
+        return self
+
+    def read(self):
+        """
+        Read the notifications of the connection, opening it again in the background when it was lost
+        :return: None
+        """
+        if self.connection is None:
+            return
+        try:
+            self.connection.poll()
+        except (psycopg2.InterfaceError, psycopg2.OperationalError) as exception:
+            logger.warning('Subscription connection was lost: %s', exception)
+            self.disconnect()
+            self.reconnecting = asyncio.ensure_future(self.reconnect())
+            return
+        while len(self.connection.notifies) > 0:
+            self.notifications.put_nowait(self.connection.notifies.pop(0))
+
+    async def reconnect(self):
+        """
+        Open the connection again, waiting for the reconnect delay between attempts
+        :return: None
+        """
+        while not self.closed:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.connect()
+            except psycopg2.OperationalError as exception:
+                logger.warning('Subscription connection could not be opened: %s', exception)
+                continue
+            self.reconnecting = None
+            self.reconnects += 1
+            if self.on_reconnect is not None:
+                result = self.on_reconnect(self)
+                if asyncio.iscoroutine(result):
+                    await result
+            return
+
+    @staticmethod
+    async def send(connection, sql):
+        """
+        Send a command and wait for its result
+        :param connection: Connection
+        :param sql: SQL string
+        :return: None
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            await AsyncConnectionPool.poll(connection)
+
+    async def unlisten(self, *channels):
+        """
+        Stop listening on channels
+        :param channels: Channel names
+        :return: Self
+        """
+        await self.command('unlisten', [channel for channel in channels if channel in self.channels])
+        self.channels = [channel for channel in self.channels if channel not in channels]
+        return self
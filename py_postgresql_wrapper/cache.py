@@ -0,0 +1,213 @@
+import collections
+import sys
+import threading
+import time
+
+
+class CachedCursor(object):
+
+    """
+    Cursor over cached rows
+    """
+
+    def __init__(self, rows, description=None):
+        self.description = description
+        self.index = 0
+        self.rowcount = len(rows)
+        self.rows = rows
+
+    def close(self):
+        """
+        Close the cursor
+        :return: None
+        """
+        self.index = len(self.rows)
+
+    def fetchall(self):
+        """
+        Fetch the remaining rows
+        :return: Rows
+        """
+        return self.fetchmany(len(self.rows))
+
+    def fetchmany(self, size):
+        """
+        Fetch the next rows
+        :param size: Number of rows
+        :return: Rows
+        """
+        rows = self.rows[self.index:self.index + size]
+        self.index += len(rows)
+        return rows
+
+    def fetchone(self):
+        """
+        Fetch the next row
+        :return: Row, None when there are no more rows
+        """
+        rows = self.fetchmany(1)
+        return rows[0] if len(rows) > 0 else None
+
+
+class ResultCache(object):
+
+    """
+    Cache of select results with TTL and LRU eviction bounded by memory, invalidated by table tags
+    """
+
+    def __init__(self, ttl=60, max_bytes=64 * 1024 * 1024):
+        self.entries = collections.OrderedDict()
+        self.evictions = 0
+        self.hits = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.misses = 0
+        self.size = 0
+        self.tags = {}
+        self.ttl = ttl
+
+    def clear(self):
+        """
+        Remove all entries
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.tags = {}
+
+    @staticmethod
+    def freeze(value):
+        """
+        Hashable representation of parameters
+        :param value: SQL parameters
+        :return: Hashable value
+        """
+        if isinstance(value, dict):
+            return tuple(sorted((key, ResultCache.freeze(item)) for key, item in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(ResultCache.freeze(item) for item in value)
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return repr(value)
+
+    def get(self, key):
+        """
+        Get the rows of a key
+        :param key: Cache key
+        :return: Cursor over the rows, None when missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return CachedCursor(entry[1], entry[4])
+
+    def invalidate(self, tags):
+        """
+        Remove the entries of tags
+        :param tags: Table tags
+        :return: None
+        """
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self.remove(key)
+                    self.invalidations += 1
+
+    @staticmethod
+    def key(sql, parameters, dictionaries=True):
+        """
+        Key of a query, on the exact SQL string as white spaces can be part of its literals
+        :param sql: SQL string
+        :param parameters: SQL parameters
+        :param dictionaries: Rows are dicts, else tuples
+        :return: Cache key
+        """
+        return sql, ResultCache.freeze(parameters), dictionaries
+
+    def remove(self, key):
+        """
+        Remove an entry, the lock must be held
+        :param key: Cache key
+        :return: None
+        """
+        _, _, size, tags, _ = self.entries.pop(key)
+        self.size -= size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.tags[tag]
+
+    def set(self, key, rows, tags=(), ttl=None, description=None):
+        """
+        Set the rows of a key, evicting the least recently used entries above the memory bound
+        :param key: Cache key
+        :param rows: Rows
+        :param tags: Table tags
+        :param ttl: Time to live in seconds
+        :param description: Description of the result columns
+        :return: None
+        """
+        size = ResultCache.sizeof(rows)
+        if size > self.max_bytes:
+            return
+        tags = tuple(ResultCache.tag(tag) for tag in tags)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), rows, size, tags, description)
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    @staticmethod
+    def sizeof(rows):
+        """
+        Estimate the memory used by rows
+        :param rows: Rows
+        :return: Size in bytes
+        """
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in (row.values() if isinstance(row, dict) else row))
+        return size
+
+    def statistics(self):
+        """
+        Hit and miss counters of the cache
+        :return: Dict
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'bytes': self.size,
+                'entries': len(self.entries),
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / requests if requests > 0 else None,
+                'hits': self.hits,
+                'invalidations': self.invalidations,
+                'misses': self.misses
+            }
+
+    @staticmethod
+    def tag(table):
+        """
+        Tag of a table
+        :param table: Table name, possibly with an alias
+        :return: Tag
+        """
+        return table.split()[0].lower()
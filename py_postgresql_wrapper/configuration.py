@@ -1,8 +1,22 @@
-from dbutils.pooled_db import PooledDB
+from .cache import ResultCache
+from .instrumentation import Instrumentation, SlowQueryLog
+from dbutils.pooled_db import PooledDB, TooManyConnections
 
+import itertools
 import json
 import os
 import psycopg2
+import select
+import time
+
+CONNECTION_KEYS = {
+    'database': ('dbname', str),
+    'host': ('host', str),
+    'max_connection': ('maxconnections', int),
+    'password': ('password', str),
+    'port': ('port', int),
+    'username': ('user', str)
+}
 
 
 class Configuration(object):
@@ -24,6 +38,38 @@ class Configuration(object):
                     self.data = json.loads(file.read())
                 except json.decoder.JSONDecodeError as exception:
                     raise ConfigurationInvalidException(exception)
+        source = self.data
+        self.pool_options = {
+            'idle_timeout': self.data.get('pool_idle_timeout'),
+            'max_idle': int(self.data.get('pool_max_idle', 0)),
+            'max_lifetime': self.data.get('pool_max_lifetime'),
+            'min_idle': int(self.data.get('pool_min_idle', 0)),
+            'ping_after': self.data.get('pool_ping_after', 60),
+            'timeout': self.data.get('pool_timeout')
+        }
+        for key in ('idle_timeout', 'max_lifetime', 'ping_after', 'timeout'):
+            if self.pool_options[key] is not None:
+                self.pool_options[key] = float(self.pool_options[key])
+        self.prepared_statements = int(self.data.get('prepared_statements', 0))
+        replicas = self.data.get('replicas', [])
+        self.replica_stickiness = bool(self.data.get('replica_stickiness', True))
+        self.replica_strategy = str(self.data.get('replica_strategy', 'round_robin'))
+        if self.replica_strategy not in ('least_in_use', 'round_robin'):
+            raise ConfigurationInvalidException('{} is not a valid replica strategy'.format(self.replica_strategy))
+        self.shard_key = self.data.get('shard_key')
+        shards = self.data.get('shards', [])
+        if len(shards) > 0 and self.shard_key is None:
+            raise ConfigurationInvalidException('Shards require a shard key')
+        result_cache = {
+            'max_bytes': int(self.data.get('result_cache_max_bytes', 64 * 1024 * 1024)),
+            'ttl': float(self.data.get('result_cache_ttl', 60))
+        }
+        slow_query = {
+            'explain': bool(self.data.get('slow_query_explain', False)),
+            'redact': self.data.get('slow_query_redact', True),
+            'sample_rate': float(self.data.get('slow_query_sample_rate', 1.0)),
+            'threshold': self.data.get('slow_query_ms')
+        }
         self.data = {
             "dbname": str(self.data['database']),
             "host": str(self.data['host']),
@@ -33,8 +79,87 @@ class Configuration(object):
             "print_sql": bool(self.data['print_sql']),
             "user": str(self.data['username'])
         }
+        self.async_pool = None
+        self.instrumentation = Instrumentation()
+        self.slow_query_log = None
+        if slow_query['threshold'] is not None:
+            slow_query['threshold'] = float(slow_query['threshold'])
+            self.slow_query_log = SlowQueryLog(self, **slow_query)
+            self.instrumentation.subscribe(self.slow_query_log)
         self.print_sql = self.data.pop('print_sql') if 'print_sql' in self.data else False
-        self.pool = PooledDB(psycopg2, **self.data)
+        self.replica_counter = itertools.count()
+        self.replica_data = []
+        for replica in replicas:
+            data = dict(self.data)
+            for key, value in replica.items():
+                if key not in CONNECTION_KEYS:
+                    raise ConfigurationInvalidException('{} is not a valid replica key'.format(key))
+                data[CONNECTION_KEYS[key][0]] = CONNECTION_KEYS[key][1](value)
+            self.replica_data.append(data)
+        self.result_cache = ResultCache(**result_cache)
+        self.shards = []
+        for shard in shards:
+            data = {key: value for key, value in source.items() if key not in ('replicas', 'shard_key', 'shards')}
+            for key in shard.keys():
+                if key not in CONNECTION_KEYS and key != 'replicas':
+                    raise ConfigurationInvalidException('{} is not a valid shard key'.format(key))
+            data.update(shard)
+            self.shards.append(Configuration(configuration_dict=data))
+        self.create_pools()
+
+    def create_pools(self):
+        """
+        Create the connection pools of the primary and the replicas in the current process
+        :return: None
+        """
+        self.pid = os.getpid()
+        self.primary_pool = ConnectionPool(**self.pool_options, **self.data)
+        self.replica_pools = [ConnectionPool(**self.pool_options, **data) for data in self.replica_data]
+
+    def fork(self):
+        """
+        Replace the pools inherited from the parent process, detaching their connections without closing them in the
+        server, as they are still used by the parent
+        :return: None
+        """
+        for pool in [self.primary_pool] + self.replica_pools:
+            pool.detach()
+        if self.async_pool is not None:
+            self.async_pool.detach()
+            self.async_pool = None
+        self.create_pools()
+
+    def gauges(self):
+        """
+        Gauges of the connection pools
+        :return: Dict of pool name and gauges
+        """
+        idle = len(self.pool._idle_cache)
+        gauges = {
+            'primary': {
+                'idle': idle,
+                'in_use': self.pool._connections,
+                'max': self.pool._maxconnections,
+                'size': idle + self.pool._connections
+            }
+        }
+        for index, replica in enumerate(self.replicas):
+            idle = len(replica._idle_cache)
+            gauges['replica_{}'.format(index)] = {
+                'idle': idle,
+                'in_use': replica._connections,
+                'max': replica._maxconnections,
+                'size': idle + replica._connections
+            }
+        if self.async_pool is not None:
+            gauges['async'] = {
+                'idle': len(self.async_pool.idle),
+                'in_use': self.async_pool.opened - len(self.async_pool.idle),
+                'max': self.async_pool.size,
+                'size': self.async_pool.opened,
+                'waiting': len(self.async_pool.waiters)
+            }
+        return gauges
 
     @staticmethod
     def instance(configuration_dict=None, configuration_file='/etc/py_postgresql_wrapper/configuration.json'):
@@ -48,6 +173,171 @@ class Configuration(object):
             Configuration.__instance__ = Configuration(configuration_dict, configuration_file)
         return Configuration.__instance__
 
+    @property
+    def pool(self):
+        """
+        Pool of the primary, created again in a forked process
+        :return: Pool
+        """
+        if self.pid != os.getpid():
+            self.fork()
+        return self.primary_pool
+
+    def replica(self):
+        """
+        Choose the pool of a replica, by round robin or by the least connections in use
+        :return: Replica pool, None when there are no replicas
+        """
+        if len(self.replicas) == 0:
+            return None
+        if self.replica_strategy == 'least_in_use':
+            return min(self.replicas, key=lambda replica: replica._connections)
+        return self.replicas[next(self.replica_counter) % len(self.replicas)]
+
+    @property
+    def replicas(self):
+        """
+        Pools of the replicas, created again in a forked process
+        :return: List of pools
+        """
+        if self.pid != os.getpid():
+            self.fork()
+        return self.replica_pools
+
+    def statistics(self):
+        """
+        Snapshot of the query, pool and result cache statistics
+        :return: Dict
+        """
+        statistics = self.instrumentation.snapshot(self.gauges())
+        statistics['result_cache'] = self.result_cache.statistics()
+        return statistics
+
+
+class ConnectionPool(PooledDB):
+
+    """
+    Pool of connections prewarmed up to the minimum idle, recycled by age and idle time and checked on checkout
+    """
+
+    def __init__(self, min_idle=0, max_idle=0, max_lifetime=None, idle_timeout=None, ping_after=60, timeout=None, **data):
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.min_idle = min_idle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        super(ConnectionPool, self).__init__(psycopg2, mincached=min_idle, maxcached=max_idle, ping=0, **data)
+
+    def alive(self, connection):
+        """
+        Check a connection, with a round trip only when it was idle for longer than ping after or its socket has data
+        to read, as an idle connection only receives data when the server closed it
+        :param connection: Steady connection
+        :return: True when the connection is alive
+        """
+        raw = connection._con
+        if raw.closed:
+            return False
+        try:
+            idle = self.ping_after is not None and time.monotonic() - connection.returned > self.ping_after
+            if idle or len(select.select([raw], [], [], 0)[0]) > 0:
+                cursor = raw.cursor()
+                cursor.execute('select 1')
+                cursor.close()
+                raw.rollback()
+        except Exception:
+            return False
+        return True
+
+    def cache(self, connection):
+        """
+        Put a connection back into the idle connections
+        :param connection: Steady connection
+        :return: None
+        """
+        connection.returned = time.monotonic()
+        super(ConnectionPool, self).cache(connection)
+
+    def connection(self, shareable=True, timeout=None):
+        """
+        Check out a dedicated connection, closing the connections idle for longer than the idle timeout and opening again
+        the connection when it is older than the max lifetime or it is not alive
+        :param shareable: Ignored, connections are not shared
+        :param timeout: Time limit in seconds of the wait for a connection when all are in use, bounded by the timeout
+        of the pool; without timeout of the pool the checkout fails at once
+        :return: Pooled connection
+        """
+        self.expire()
+        if self.timeout is None:
+            timeout = 0
+        elif timeout is None:
+            timeout = self.timeout
+        else:
+            timeout = min(timeout, self.timeout)
+        with self._lock:
+            deadline = time.monotonic() + timeout
+            while self._maxconnections and self._connections >= self._maxconnections:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutException('No connection was released in {:g} seconds'.format(timeout))
+                self._lock.wait(remaining)
+            pooled = super(ConnectionPool, self).connection(False)
+        connection = pooled._con
+        try:
+            expired = self.max_lifetime is not None and time.monotonic() - connection.created > self.max_lifetime
+            if expired or not self.alive(connection):
+                connection._close()
+                connection._store(connection._create())
+                connection.created = time.monotonic()
+        except BaseException:
+            pooled.close()
+            raise
+        return pooled
+
+    def detach(self):
+        """
+        Detach the idle connections inherited from the parent process, redirecting their sockets to /dev/null before
+        closing them so that the connections of the parent are not terminated
+        :return: None
+        """
+        null = os.open(os.devnull, os.O_RDWR)
+        try:
+            while len(self._idle_cache) > 0:
+                connection = self._idle_cache.pop()
+                if not connection._con.closed:
+                    os.dup2(null, connection._con.fileno())
+                    connection._con.close()
+        finally:
+            os.close(null)
+
+    def expire(self):
+        """
+        Close the connections idle for longer than the idle timeout, keeping the minimum idle
+        :return: None
+        """
+        if self.idle_timeout is None:
+            return
+        expired = []
+        limit = time.monotonic() - self.idle_timeout
+        with self._lock:
+            for connection in list(self._idle_cache):
+                if len(self._idle_cache) <= self.min_idle:
+                    break
+                if connection.returned < limit:
+                    self._idle_cache.remove(connection)
+                    expired.append(connection)
+        for connection in expired:
+            connection.close()
+
+    def steady_connection(self):
+        """
+        Open a steady connection
+        :return: Steady connection
+        """
+        connection = super(ConnectionPool, self).steady_connection()
+        connection.created = connection.returned = time.monotonic()
+        return connection
+
 
 class ConfigurationInvalidException(Exception):
 
@@ -61,3 +351,10 @@ class ConfigurationNotFoundException(Exception):
     """
     Configuration file was not found
     """
+
+
+class PoolTimeoutException(TooManyConnections):
+
+    """
+    No connection of the pool was released in the time limit of the checkout
+    """
@@ -1,11 +1,53 @@
+from .cache import CachedCursor, ResultCache
 from .configuration import Configuration
+from .instrumentation import Instrumentation, logger
 
+import base64
+import collections
+import concurrent.futures
+import copy
 import errno
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
-
+import queue
+import re
+import select
+import struct
+import threading
+import time
+import uuid
+import weakref
+
+COLUMN_TYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int16',
+    23: 'int32',
+    700: 'float32',
+    701: 'float64',
+    1082: 'datetime64[D]',
+    1114: 'datetime64[us]',
+    1700: 'float64'
+}
+COUNT_WINDOW = 10
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('!h', -1)
+DEALLOCATE_PATTERN = re.compile(r'^\s*(deallocate|discard)\b', re.IGNORECASE)
+LOCKING_PATTERN = re.compile(r'\bfor\s+(update|no\s+key\s+update|share|key\s+share)\b', re.IGNORECASE)
+PARAMETER_PATTERN = re.compile(r'%\(([^)]+)\)s|%s|%%')
+PREPARABLE_PATTERN = re.compile(r'^\s*(select|insert|update|delete|values|with)\b', re.IGNORECASE)
 QUERIES_DIRECTORY = os.path.realpath(os.path.curdir) + '/queries/'
+QUERY_NAME_PATTERN = re.compile(r'^[\w\-./]+$')
+READ_ONLY_PATTERN = re.compile(r'^\s*select\b', re.IGNORECASE)
+ROW_FORMATS = ('dict', 'record', 'tuple', 'wrapper')
 
 
 class Database(object):
@@ -14,20 +56,237 @@ class Database(object):
     Facade to access database
     """
 
+    def __del__(self):
+        if hasattr(self, 'streams'):
+            self.close_streams()
+
     def __enter__(self):
         return self
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
-        if exception_type is None and exception_value is None and exception_traceback is None:
-            self.connection.commit()
-        else:
-            self.connection.rollback()
-        self.disconnect()
-
-    def __init__(self, configuration=None):
+        success = exception_type is None and exception_value is None and exception_traceback is None
+        error = None
+        self.close_streams()
+        try:
+            if success:
+                self.flush()
+        except BaseException as exception:
+            error = exception
+            success = False
+        try:
+            for connection in (self.primary_connection, self.replica_connection):
+                if connection is None:
+                    continue
+                if success:
+                    connection.commit()
+                else:
+                    connection.rollback()
+            if success:
+                self.configuration.result_cache.invalidate(self.invalidated)
+        finally:
+            for _, _, result in self.deferred_statements:
+                result.exception = RuntimeError('Deferred statement was not executed, the transaction was rolled back')
+            self.deferred_notifications = []
+            self.deferred_statements = []
+            self.invalidated = set()
+            self.loaders = {}
+            self.statement_timeouts = {}
+            self.disconnect()
+        if error is not None:
+            raise error
+
+    def __init__(self, configuration=None, replica=True, deferred=False, timeout=None):
         self.configuration = Configuration.instance() if configuration is None else configuration
-        self.connection = self.configuration.pool.connection()
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.deferred = deferred
+        self.deferred_notifications = []
+        self.deferred_statements = []
+        self.instrumentation = self.configuration.instrumentation
+        self.invalidated = set()
+        self.loaders = {}
+        self.prepared_statements = self.configuration.prepared_statements
+        self.primary_connection = None
         self.print_sql = self.configuration.print_sql
+        self.replica = replica and len(self.configuration.replicas) > 0
+        self.replica_connection = None
+        self.statement_timeouts = {}
+        self.streams = []
+        self.timeout = timeout
+        self.written = False
+
+    def cancel(self):
+        """
+        Cancel the statements running in the connections, from another thread
+        :return: None
+        """
+        for connection in (self.primary_connection, self.replica_connection):
+            if connection is not None:
+                connection.cancel()
+
+    def checkout(self, pool):
+        """
+        Check out a connection from a pool, in a transaction so that a failed statement is raised instead of being
+        executed again in a new connection
+        :param pool: Pool
+        :return: Connection
+        """
+        start = time.perf_counter()
+        try:
+            connection = pool.connection(timeout=self.remaining())
+        except Exception as exception:
+            self.instrumentation.checkout(time.perf_counter() - start, exception)
+            raise
+        self.instrumentation.checkout(time.perf_counter() - start)
+        connection.begin()
+        return connection
+
+    def close_streams(self):
+        """
+        Close the copy streams still open, their copy running in a connection of the database
+        :return: None
+        """
+        while len(self.streams) > 0:
+            self.streams.pop().close()
+
+    @property
+    def connection(self):
+        """
+        Connection to the primary, checked out on first use
+        :return: Connection
+        """
+        if self.primary_connection is None:
+            self.primary_connection = self.checkout(self.configuration.pool)
+        return self.primary_connection
+
+    @connection.setter
+    def connection(self, connection):
+        self.primary_connection = connection
+
+    def copy_in(self, table, rows, columns=None, format='text', buffer_size=65536):
+        """
+        Stream rows into a table with copy from stdin, invalidating the cached rows of the table on commit
+        :param table: Table name
+        :param rows: Iterable of dicts or tuples
+        :param columns: Table columns, taken from the first row when it is a dict
+        :param format: Copy format, text or binary
+        :param buffer_size: Maximum size of the buffer sent to the server at once
+        :return: Cursor
+        """
+        self.flush()
+        self.invalidate(table)
+        iterator = iter(rows)
+        first = next(iterator, None)
+        if columns is None and isinstance(first, dict):
+            columns = list(first.keys())
+        if first is not None:
+            iterator = itertools.chain([first], iterator)
+        if columns is None:
+            sql = 'copy {} from stdin with (format {})'.format(table, format)
+        else:
+            sql = 'copy {} ({}) from stdin with (format {})'.format(table, ', '.join(columns), format)
+        if self.print_sql:
+            logger.info('Query: %s - Parameters: %s', sql, None)
+        cursor = self.route(sql, False).cursor()
+        cursor.copy_expert(sql, CopyInStream(iterator, columns, format), buffer_size)
+        return CursorWrapper(cursor)
+
+    def copy_out(self, sql, parameters=None, sink=None, format='csv', header=True, skip_load_query=False, buffer_size=65536, replica=None):
+        """
+        Export the result of a query with copy to stdout
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param sink: File-like object to write into, when not given the data is returned as a stream of bytes chunks
+        :param format: Copy format, csv, text or binary
+        :param header: Write a header line, for csv format
+        :param skip_load_query: Skip load file
+        :param buffer_size: Size of the chunks read from the server
+        :param replica: Execute in a replica, by default only the read-only query files
+        :return: Cursor when a sink was given, else a stream of bytes chunks
+        """
+        self.flush()
+        if skip_load_query:
+            sql = sql
+        else:
+            name = sql
+            sql = self.load_query(sql)
+            if replica is None and sql is not name:
+                replica = Database.read_only(sql)
+        cursor = self.route(sql, replica).cursor()
+        sql = cursor.mogrify(sql.strip().rstrip(';'), parameters).decode(psycopg2.extensions.encodings[cursor.connection.encoding])
+        sql = 'copy ({}) to stdout with (format {}{})'.format(sql, format, ', header' if header and format == 'csv' else '')
+        if self.print_sql:
+            logger.info('Query: %s - Parameters: %s', sql, None)
+        if sink is None:
+            self.streams = [stream for stream in self.streams if not stream.closed]
+            self.streams.append(CopyOutStream(cursor, sql, buffer_size))
+            return self.streams[-1]
+        cursor.copy_expert(sql, sink, buffer_size)
+        return CursorWrapper(cursor)
+
+    def count(self, sql, parameters=None, strategy='exact', limit=None, table=None, skip_load_query=True):
+        """
+        Count the rows of a query
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param strategy: Count strategy, exact, window counting up to the limit or estimate by the planner
+        :param limit: Maximum number of rows counted, for window strategy
+        :param table: Table of the query when it selects the whole table, for estimate strategy
+        :param skip_load_query: Skip load file
+        :return: Number of rows
+        """
+        if skip_load_query:
+            sql = sql
+        else:
+            sql = self.load_query(sql)
+        return self.run(self.count_statements(sql, parameters, strategy, limit, table), True)
+
+    @staticmethod
+    def count_statements(sql, parameters=None, strategy='exact', limit=None, table=None):
+        """
+        Statements counting the rows of a query
+        :param sql: SQL string
+        :param parameters: SQL parameters
+        :param strategy: Count strategy, exact, window counting up to the limit or estimate by the planner
+        :param limit: Maximum number of rows counted, for window strategy
+        :param table: Table of the query when it selects the whole table, for estimate strategy
+        :return: Generator of statements returning the number of rows
+        """
+        if strategy == 'estimate':
+            if table is not None:
+                data = (yield 'select reltuples::bigint as total from pg_class where oid = to_regclass(%(table)s)', {'table': table}).fetch_one()
+                if data is not None and data.total >= 0:
+                    return data.total
+            data = (yield 'explain (format json) {}'.format(sql), parameters).fetch_one()
+            return int(data['QUERY PLAN'][0]['Plan']['Plan Rows'])
+        if strategy == 'window':
+            sql = 'select count(*) as total from (select 1 from ({}) as paging limit {}) as count'.format(sql, limit)
+        elif strategy == 'exact':
+            sql = 'select count(*) as total from ({}) as count'.format(sql)
+        else:
+            raise ValueError('{} is not a valid count strategy'.format(strategy))
+        return (yield sql, parameters).fetch_one().total
+
+    @staticmethod
+    def cursor_factory(row_format):
+        """
+        Cursor factory of a row format
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :return: Cursor factory, None for the cursors returning tuples
+        """
+        if row_format not in ROW_FORMATS:
+            raise ValueError('{} is not a valid row format'.format(row_format))
+        return psycopg2.extras.RealDictCursor if row_format == 'wrapper' else None
+
+    def defer(self, sql, parameters=None):
+        """
+        Queue an insert, update or delete until the next flush, at commit, on explicit flush or before other statements
+        :param sql: SQL string, without returning
+        :param parameters: SQL parameters
+        :return: Deferred result
+        """
+        result = DeferredResult(self)
+        self.deferred_statements.append((sql, parameters, result))
+        return result
 
     def delete(self, table):
         """
@@ -42,25 +301,183 @@ class Database(object):
         Disconnect from database
         :return: None
         """
-        self.connection.close()
+        if self.primary_connection is not None:
+            self.primary_connection.close()
+            self.primary_connection = None
+        if self.replica_connection is not None:
+            self.replica_connection.close()
+            self.replica_connection = None
 
-    def execute(self, sql, parameters=None, skip_load_query=False):
+    def execute(self, sql, parameters=None, skip_load_query=False, replica=None, cache=None, tags=None, row_format='wrapper', timeout=None, prepare=False):
         """
         Execute query by name
         :param sql: String or name of file
         :param parameters: SQL parameters
         :param skip_load_query: Skip load file
+        :param replica: Execute in a replica, by default only the read-only query files
+        :param cache: Cache the rows, True for the default TTL or the TTL in seconds
+        :param tags: Tables read by the query, its cached rows are invalidated when they are written
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :param timeout: Time limit in seconds, bounded by the timeout of the database
+        :param prepare: Execute with a prepared statement when they are enabled, always for the query files
         :return: Cursor
         """
-        cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor_factory = Database.cursor_factory(row_format)
+        self.flush()
         if self.print_sql:
-            print('Query: {} - Parameters: {}'.format(sql, parameters))
+            logger.info('Query: %s - Parameters: %s', sql, parameters)
+        key = sql
         if skip_load_query:
             sql = sql
         else:
             sql = self.load_query(sql)
-        cursor.execute(sql, parameters)
-        return CursorWrapper(cursor)
+            prepare = prepare or sql is not key
+            if replica is None and sql is not key:
+                replica = Database.read_only(sql)
+        cache_key = None
+        if cache and self.invalidated.isdisjoint(ResultCache.tag(tag) for tag in tags or ()):
+            cache_key = ResultCache.key(sql, parameters, cursor_factory is not None)
+            cursor = self.configuration.result_cache.get(cache_key)
+            if cursor is not None:
+                return CursorWrapper(cursor, row_format=row_format)
+        statement_timeout = self.timeout if timeout is None else timeout
+        timeout = self.remaining(timeout)
+        cursor = self.route(sql, replica).cursor(cursor_factory=cursor_factory)
+        prefix = self.statement_timeout(cursor.connection, statement_timeout)
+        start = time.perf_counter()
+        token = None if timeout is None else Watchdog.instance().watch(cursor.connection, time.monotonic() + timeout)
+        try:
+            if self.prepared_statements > 0 and prepare and parameters is not None:
+                if prefix != '':
+                    cursor.execute(prefix)
+                PreparedStatementCache.connection(cursor.connection, self.prepared_statements).execute(cursor, sql, parameters)
+            else:
+                if self.prepared_statements > 0 and DEALLOCATE_PATTERN.match(sql) is not None:
+                    PreparedStatementCache.connection(cursor.connection, self.prepared_statements).clear()
+                cursor.execute(prefix + sql, parameters)
+        except Exception as exception:
+            self.instrumentation.query(Instrumentation.shape(key), time.perf_counter() - start, None, exception, sql, parameters)
+            if timeout is not None and isinstance(exception, psycopg2.errors.QueryCanceled):
+                raise QueryTimeoutException('Query did not finish in {:g} seconds'.format(timeout)) from exception
+            raise
+        finally:
+            if token is not None:
+                Watchdog.instance().unwatch(token)
+        self.instrumentation.query(Instrumentation.shape(key), time.perf_counter() - start, cursor.rowcount, None, sql, parameters)
+        if cache_key is not None:
+            rows = cursor.fetchall()
+            cursor.close()
+            self.configuration.result_cache.set(cache_key, rows, tags or (), None if cache is True else cache, cursor.description)
+            return CursorWrapper(CachedCursor(rows, cursor.description), row_format=row_format)
+        return CursorWrapper(cursor, row_format=row_format)
+
+    def flush(self):
+        """
+        Execute the deferred statements and notifications in one round trip, each statement counting its rows into a
+        setting local to the transaction read by a last select; when a statement fails, the statements are rolled back
+        to a savepoint and executed again one by one, mapping the error to the statement that raised it; the copy
+        streams still open are closed first, as their connection can not run other statements meanwhile
+        :return: None
+        """
+        self.close_streams()
+        if len(self.deferred_statements) == 0 and len(self.deferred_notifications) == 0:
+            return
+        notifications = self.deferred_notifications
+        statements = self.deferred_statements
+        self.deferred_notifications = []
+        self.deferred_statements = []
+        cursor = self.connection.cursor()
+        encoding = psycopg2.extensions.encodings[cursor.connection.encoding]
+        sql = ['savepoint py_postgresql_wrapper_flush']
+        for index, (statement, parameters, _) in enumerate(statements):
+            sql.append(
+                'with deferred as ({} returning 1) '
+                'select set_config(\'py_postgresql_wrapper.deferred_{}\', count(*)::text, true) from deferred'.format(
+                    cursor.mogrify(statement, parameters).decode(encoding).strip().rstrip(';'), index
+                )
+            )
+        for channel, payload in notifications:
+            sql.append(cursor.mogrify(*Database.notify_statement(channel, payload)).decode(encoding))
+        sql.append('release savepoint py_postgresql_wrapper_flush')
+        sql.append('select {}'.format(', '.join(
+            'current_setting(\'py_postgresql_wrapper.deferred_{}\')::bigint'.format(index) for index in range(len(statements))
+        )))
+        cursor.close()
+        try:
+            counts = self.execute(';\n'.join(sql), None, True, False, row_format='tuple').fetch_one()
+        except psycopg2.Error:
+            self.execute('rollback to savepoint py_postgresql_wrapper_flush', None, True, False)
+            for index, (statement, parameters, result) in enumerate(statements):
+                try:
+                    result.count = self.execute(statement, parameters, True, False).row_count()
+                except Exception as exception:
+                    result.exception = exception
+                    for _, _, skipped in statements[index + 1:]:
+                        skipped.exception = RuntimeError('Deferred statement was not executed, a previous one failed')
+                    raise
+            self.execute('release savepoint py_postgresql_wrapper_flush', None, True, False)
+            for channel, payload in notifications:
+                self.notify(channel, payload)
+            return
+        for count, (_, _, result) in zip(counts, statements):
+            result.count = count
+
+    def gather(self, queries, workers=None, timeout=None):
+        """
+        Execute independent queries concurrently, each one in its own pooled connection and transaction
+        :param queries: Builders, SQL strings or tuples of SQL string and parameters
+        :param workers: Maximum number of concurrent connections, by default one by query up to the free connections of the pool
+        :param timeout: Time limit in seconds for all the queries, the checkouts and queries still running are cancelled
+        :return: Rows or row count of each query in order, or the exception it raised
+        """
+        if len(queries) == 0:
+            return []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if workers is None:
+            pool = self.configuration.pool
+            workers = max(1, min(len(queries), pool._maxconnections - pool._connections)) if pool._maxconnections else len(queries)
+        lock = threading.Lock()
+        running = {}
+
+        def execute(index, query):
+            with Database(self.configuration, self.replica, timeout=None if deadline is None else deadline - time.monotonic()) as database:
+                with lock:
+                    running[index] = database
+                try:
+                    if isinstance(query, SQLBuilder):
+                        query = copy.copy(query)
+                        query.database = database
+                        cursor = query.execute()
+                    elif isinstance(query, str):
+                        cursor = database.execute(query)
+                    else:
+                        cursor = database.execute(*query)
+                    if not isinstance(cursor, CursorWrapper):
+                        return cursor
+                    return cursor.fetch_all() if cursor.cursor.description is not None else cursor.row_count()
+                finally:
+                    with lock:
+                        del running[index]
+
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        try:
+            futures = [executor.submit(execute, index, query) for index, query in enumerate(queries)]
+            _, pending = concurrent.futures.wait(futures, timeout)
+            for future in pending:
+                future.cancel()
+            with lock:
+                for database in running.values():
+                    database.cancel()
+        finally:
+            executor.shutdown(wait=True)
+        results = []
+        for future in futures:
+            exception = None if future.cancelled() else future.exception()
+            if future.cancelled() or isinstance(exception, QueryTimeoutException) or future in pending and exception is not None:
+                results.append(TimeoutError('Query did not finish in {} seconds'.format(timeout)))
+            else:
+                results.append(exception or future.result())
+        return results
 
     def insert(self, table):
         """
@@ -70,6 +487,79 @@ class Database(object):
         """
         return InsertBuilder(self, table)
 
+    def invalidate(self, *tables):
+        """
+        Invalidate the cached rows of tables when the transaction is committed, and the rows loaded by the loaders
+        :param tables: Table names
+        :return: None
+        """
+        tags = set(ResultCache.tag(table) for table in tables)
+        self.invalidated.update(tags)
+        for loader in self.loaders.values():
+            if ResultCache.tag(loader.builder.table) in tags:
+                loader.clear()
+
+    def listen(self, *channels, reconnect_delay=1.0, on_reconnect=None):
+        """
+        Subscription to notification channels in a dedicated connection, outside of the transaction and of the pool
+        :param channels: Channel names
+        :param reconnect_delay: Seconds waited before opening the connection again when it is lost
+        :param on_reconnect: Function called with the subscription after the connection was opened again, as the
+        notifications sent meanwhile were lost
+        :return: Subscription
+        """
+        return Subscription(self.configuration, channels, reconnect_delay, on_reconnect)
+
+    def loader(self, table, key='id', many=False, batch_size=1000):
+        """
+        Loader of rows by key, the same loader is returned for the same select and key until the end of the transaction
+        :param table: Table name or select builder
+        :param key: Key field
+        :param many: Load the list of rows of each key, else one row
+        :param batch_size: Maximum number of keys by query
+        :return: Loader
+        """
+        builder = table if isinstance(table, SelectBuilder) else self.select(table)
+        name = (builder.sql(), ResultCache.freeze(builder.parameters), key, many)
+        if name not in self.loaders:
+            self.loaders[name] = Loader(builder, key, many, batch_size)
+        return self.loaders[name]
+
+    def notify(self, channel, payload=None):
+        """
+        Notify a channel, the notification is delivered to the listeners when the transaction is committed
+        :param channel: Channel name
+        :param payload: Payload string, or a dict or list encoded in JSON
+        :return: Cursor
+        """
+        return self.execute(*Database.notify_statement(channel, payload), True, False)
+
+    def notify_after(self, result, notifications):
+        """
+        Notify the channels of a builder after its execution, queued until the next flush in a deferred database
+        :param result: Result of the execution
+        :param notifications: List of channel and payload
+        :return: Result of the execution
+        """
+        if self.deferred:
+            self.deferred_notifications.extend(notifications)
+            return result
+        for channel, payload in notifications:
+            self.notify(channel, payload)
+        return result
+
+    @staticmethod
+    def notify_statement(channel, payload=None):
+        """
+        Statement notifying a channel
+        :param channel: Channel name
+        :param payload: Payload string, or a dict or list encoded in JSON
+        :return: SQL string and parameters
+        """
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload, default=str)
+        return 'select pg_notify(%(channel)s, %(payload)s)', {'channel': channel, 'payload': '' if payload is None else str(payload)}
+
     def update(self, table):
         """
         Update string command
@@ -78,6 +568,44 @@ class Database(object):
         """
         return UpdateBuilder(self, table)
 
+    def upsert(self, table, rows, conflict, update=None, threshold=1000, batch_size=1000):
+        """
+        Insert rows or update them on conflict, with multi-row statements below the threshold and else through a staging
+        table filled with copy
+        :param table: Table name
+        :param rows: Iterable of dicts with the same keys
+        :param conflict: Conflict fields, of a unique index
+        :param update: Fields updated on conflict, by default all other fields, none to skip the conflicting rows
+        :param threshold: Maximum number of rows inserted with multi-row statements
+        :param batch_size: Number of rows by multi-row statement
+        :return: Upsert result
+        """
+        iterator = iter(rows)
+        first = list(itertools.islice(iterator, threshold + 1))
+        if len(first) <= threshold:
+            data = self.insert(table).rows(first, batch_size).on_conflict(*conflict, update=update).returning('(xmax = 0) as inserted').execute()
+            inserted = sum(1 for row in data.data if row.inserted)
+            return UpsertResult(inserted, data.row_count() - inserted)
+        columns = list(first[0].keys())
+        staging = 'py_postgresql_wrapper_{}'.format(uuid.uuid4().hex)
+        self.execute('create temporary table {} on commit drop as select {} from {} limit 0'.format(staging, ', '.join(columns), table), None, True)
+        self.copy_in(staging, itertools.chain(first, iterator), columns)
+        builder = self.insert(table).on_conflict(*conflict, update=update)
+        data = self.execute(
+            'with upsert as (insert into {0} ({1}) select {1} from {2} {3} returning (xmax = 0) as inserted) '
+            'select count(*) filter (where inserted) as inserted, count(*) filter (where not inserted) as updated from upsert'.format(
+                table,
+                ', '.join(columns),
+                staging,
+                builder.on_conflict_build(columns)
+            ),
+            None,
+            True
+        ).fetch_one()
+        self.execute('drop table {}'.format(staging), None, True)
+        self.invalidate(table)
+        return UpsertResult(data.inserted, data.updated)
+
     @staticmethod
     def load_query(name):
         """
@@ -85,17 +613,9 @@ class Database(object):
         :param name: File name
         :return: Query as a string
         """
-        try:
-            with open(QUERIES_DIRECTORY + name + '.sql') as file:
-                query = file.read()
-            return query
-        except IOError as exception:
-            if exception.errno == errno.ENOENT:
-                return name
-            else:
-                raise exception
+        return QueryRegistry.instance().get(name)
 
-    def paging(self, sql, page=0, parameters=None, size=10, skip_load_query=True):
+    def paging(self, sql, page=0, parameters=None, size=10, skip_load_query=True, order_by=None, cursor=None, count=None, timeout=None):
         """
         Paging string command
         :param sql: String or name of file
@@ -103,16 +623,121 @@ class Database(object):
         :param parameters: SQL parameters
         :param size: Page size
         :param skip_load_query: Skip load file
+        :param order_by: Order by result fields, for keyset pagination
+        :param cursor: Cursor of the previous page, for keyset pagination
+        :param count: Total count strategy, exact, window or estimate
+        :param timeout: Time limit in seconds for the page and its count
         :return:
         """
         if skip_load_query:
             sql = sql
         else:
             sql = self.load_query(sql)
-        sql = '{} limit {} offset {}'.format(sql, size + 1, page * size)
-        data = self.execute(sql, parameters, skip_load_query=True).fetch_all()
+        return self.run(self.paging_statements(sql, page, parameters, size, order_by, cursor, count), True, timeout)
+
+    @staticmethod
+    def paging_statements(sql, page=0, parameters=None, size=10, order_by=None, cursor=None, count=None):
+        """
+        Statements selecting a page of a query
+        :param sql: SQL string
+        :param page: Page number
+        :param parameters: SQL parameters
+        :param size: Page size
+        :param order_by: Order by result fields, for keyset pagination, their qualifiers are stripped in the outer query
+        :param cursor: Cursor of the previous page, for keyset pagination
+        :param count: Total count strategy, exact, window or estimate
+        :return: Generator of statements returning the page
+        """
+        base = sql
+        total = None
+        if count is not None and (count != 'exact' or order_by is not None):
+            total = yield from Database.count_statements(base, parameters, count, (page + COUNT_WINDOW) * size + 1)
+        keyset = None
+        if order_by is not None:
+            order_by = [field.split('.')[-1] for field in order_by]
+            keyset = Keyset(order_by)
+            condition = ''
+            if cursor is not None:
+                values = Keyset.decode(cursor)
+                if isinstance(parameters, (list, tuple)):
+                    parameters = list(parameters) + values
+                    placeholders = ['%s'] * len(values)
+                else:
+                    parameters = dict(parameters or {})
+                    placeholders = []
+                    for index, value in enumerate(values):
+                        parameters['keyset_{}'.format(index)] = value
+                        placeholders.append('%(keyset_{})s'.format(index))
+                condition = 'where {}'.format(keyset.condition(placeholders))
+            sql = 'select * from ({}) as paging {} order by {} limit {}'.format(sql, condition, ', '.join(order_by), size + 1)
+        elif count == 'exact':
+            sql = 'select paging.*, count(*) over() as paging_total from ({}) as paging limit {} offset {}'.format(sql, size + 1, page * size)
+        else:
+            sql = '{} limit {} offset {}'.format(sql, size + 1, page * size)
+        data = (yield sql, parameters).fetch_all()
+        if count == 'exact' and keyset is None:
+            total = Page.pop_total(data)
+            if total is None:
+                total = 0 if page == 0 else (yield from Database.count_statements(base, parameters))
         last = len(data) <= size
-        return Page(page, size, data[:-1] if not last else data, last)
+        data = data[:-1] if not last else data
+        return Page(page, size, data, last, keyset.encode(data[-1]) if keyset is not None and not last else None, total)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def read_only(sql):
+        """
+        Check if a query only reads data
+        :param sql: SQL string
+        :return: True when it is a select without locking clause
+        """
+        return READ_ONLY_PATTERN.match(sql) is not None and LOCKING_PATTERN.search(sql) is None
+
+    def remaining(self, timeout=None):
+        """
+        Time limit of a statement, bounded by the time left before the deadline of the database
+        :param timeout: Time limit in seconds
+        :return: Time limit in seconds, None when there is no limit
+        """
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is not None and timeout <= 0:
+            raise QueryTimeoutException('Deadline of {:g} seconds was exceeded'.format(self.timeout))
+        return timeout
+
+    def route(self, sql, replica=None):
+        """
+        Connection of a statement, reads go to a replica unless the primary was written with stickiness
+        :param sql: SQL string
+        :param replica: Read in a replica
+        :return: Connection
+        """
+        if replica and self.replica and not (self.written and self.configuration.replica_stickiness):
+            if self.replica_connection is None:
+                self.replica_connection = self.checkout(self.configuration.replica())
+            return self.replica_connection
+        if not self.written and not Database.read_only(sql):
+            self.written = True
+        return self.connection
+
+    def run(self, statements, replica=None, timeout=None, prepare=False):
+        """
+        Run the statements of a generator, sending back the cursor of each one
+        :param statements: Generator of SQL strings and parameters
+        :param replica: Execute in a replica
+        :param timeout: Time limit in seconds for all the statements
+        :param prepare: Execute with prepared statements when they are enabled
+        :return: Return of the generator
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            sql, parameters = next(statements)
+            while True:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                sql, parameters = statements.send(self.execute(sql, parameters, True, replica, timeout=timeout, prepare=prepare))
+        except StopIteration as stop:
+            return stop.value
 
     def select(self, table):
         """
@@ -122,6 +747,263 @@ class Database(object):
         """
         return SelectBuilder(self, table)
 
+    def statement_timeout(self, connection, timeout):
+        """
+        Command setting the statement timeout of a connection in the transaction, when it changed
+        :param connection: Connection
+        :param timeout: Time limit in seconds, None for the default of the server
+        :return: Command to execute before the statement, empty when the timeout did not change
+        """
+        milliseconds = None if timeout is None else max(1, int(timeout * 1000))
+        if self.statement_timeouts.get(id(connection)) == milliseconds:
+            return ''
+        self.statement_timeouts[id(connection)] = milliseconds
+        if milliseconds is None:
+            return 'set local statement_timeout to default; '
+        return 'set local statement_timeout = {}; '.format(milliseconds)
+
+    def stream(self, sql, parameters=None, chunk_size=1000, skip_load_query=False, replica=None, row_format='wrapper'):
+        """
+        Execute query by name with a server-side cursor, fetching the rows in chunks
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param chunk_size: Number of rows fetched from the server at once
+        :param skip_load_query: Skip load file
+        :param replica: Execute in a replica, by default only the read-only query files
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :return: Cursor
+        """
+        cursor_factory = Database.cursor_factory(row_format)
+        self.flush()
+        if self.print_sql:
+            logger.info('Query: %s - Parameters: %s', sql, parameters)
+        if skip_load_query:
+            sql = sql
+        else:
+            name = sql
+            sql = self.load_query(sql)
+            if replica is None and sql is not name:
+                replica = Database.read_only(sql)
+        cursor = self.route(sql, replica).cursor(
+            name='py_postgresql_wrapper_{}'.format(uuid.uuid4().hex),
+            cursor_factory=cursor_factory
+        )
+        cursor.execute(sql, parameters)
+        return CursorWrapper(cursor, chunk_size, row_format)
+
+
+class BatchResult(dict):
+
+    """
+    Batch result object
+    """
+
+    def __init__(self, counts, data):
+        self['counts'] = self.counts = counts
+        self['data'] = self.data = data
+        self['row_count'] = sum(counts)
+
+    def row_count(self):
+        """
+        Number of rows of all the batches
+        :return: Row count
+        """
+        return self['row_count']
+
+
+class DeferredResult(object):
+
+    """
+    Result of a deferred statement, available after the flush
+    """
+
+    def __init__(self, database):
+        self.count = None
+        self.database = database
+        self.exception = None
+
+    def row_count(self):
+        """
+        Number of rows of the statement, flushing the deferred statements when it was not executed yet
+        :return: Row count
+        """
+        if self.count is None and self.exception is None:
+            self.database.flush()
+        if self.exception is not None:
+            raise self.exception
+        return self.count
+
+
+class Keyset(object):
+
+    """
+    Keyset pagination over the order by fields
+    """
+
+    def __init__(self, order_by):
+        self.fields = []
+        directions = set()
+        for field in order_by:
+            parts = field.split()
+            if len(parts) not in (1, 2) or (len(parts) == 2 and parts[1].lower() not in ('asc', 'desc')):
+                raise ValueError('{} is not a valid keyset order by field'.format(field))
+            self.fields.append(parts[0])
+            directions.add(parts[1].lower() if len(parts) == 2 else 'asc')
+        if len(self.fields) == 0:
+            raise ValueError('Keyset pagination requires order by fields')
+        if len(directions) > 1:
+            raise ValueError('Keyset pagination requires all order by fields in the same direction')
+        self.operator = '<' if directions.pop() == 'desc' else '>'
+
+    def condition(self, placeholders):
+        """
+        Construction of the condition selecting the rows after the cursor
+        :param placeholders: Placeholders of the cursor values
+        :return: Condition
+        """
+        return '({}) {} ({})'.format(', '.join(self.fields), self.operator, ', '.join(placeholders))
+
+    @staticmethod
+    def decode(cursor):
+        """
+        Decode a cursor
+        :param cursor: Cursor
+        :return: Values of the order by fields
+        """
+        try:
+            return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError) as exception:
+            raise ValueError('{} is not a valid cursor: {}'.format(cursor, exception))
+
+    def encode(self, row):
+        """
+        Encode the cursor of a row
+        :param row: Last row of the page
+        :return: Cursor
+        """
+        values = []
+        for field in self.fields:
+            key = field.split('.')[-1]
+            if key not in row:
+                raise ValueError('Keyset field {} is not in the result'.format(key))
+            values.append(row[key])
+        return base64.urlsafe_b64encode(json.dumps(values, default=str).encode('utf-8')).decode('ascii')
+
+
+class Loader(object):
+
+    """
+    Loader of rows by key, the keys requested before a result is read are selected together in one query and the loaded
+    rows are memoized
+    """
+
+    def __init__(self, builder, key='id', many=False, batch_size=1000):
+        self.batch_size = batch_size
+        self.builder = builder
+        self.key = key
+        self.many = many
+        self.pending = {}
+        self.rows = {}
+
+    def clear(self, *keys):
+        """
+        Forget the loaded rows of keys
+        :param keys: Keys, by default all of them
+        :return: None
+        """
+        if len(keys) == 0:
+            self.rows = {}
+        for key in keys:
+            self.rows.pop(key, None)
+
+    def dispatch(self):
+        """
+        Select the requested keys
+        :return: None
+        """
+        self.builder.database.run(self.statements(), True, prepare=True)
+
+    def get(self, key):
+        """
+        Get the rows of a key, selecting the requested keys when it was not loaded yet
+        :param key: Key
+        :return: Row or list of rows, None or empty list when not found
+        """
+        if key in self.pending:
+            self.dispatch()
+        return self.rows.get(key, [] if self.many else None)
+
+    def load(self, key):
+        """
+        Request the rows of a key, selected with the other requested keys when a result is read
+        :param key: Key
+        :return: Loader result
+        """
+        if key not in self.rows:
+            self.pending[key] = None
+        return LoaderResult(self, key)
+
+    def load_many(self, keys):
+        """
+        Load the rows of keys in one query
+        :param keys: Keys
+        :return: List of rows or lists of rows, in the order of the keys
+        """
+        results = [self.load(key) for key in keys]
+        return [result.get() for result in results]
+
+    def prime(self, key, rows):
+        """
+        Set the rows of a key, without selecting it
+        :param key: Key
+        :param rows: Row or list of rows
+        :return: None
+        """
+        self.pending.pop(key, None)
+        self.rows[key] = rows
+
+    def statements(self):
+        """
+        Statements selecting the requested keys with any, in batches of batch size keys
+        :return: Generator of statements
+        """
+        keys = list(self.pending)
+        self.pending = {}
+        column = self.key.split('.')[-1]
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            select = copy.copy(self.builder)
+            select.parameters = dict(self.builder.parameters)
+            select.parameters['loader_keys'] = batch
+            select.where_clauses = list(self.builder.where_clauses)
+            select.where_conditions = list(self.builder.where_conditions)
+            select.where(self.key, '(%(loader_keys)s)', True, '= any')
+            for key in batch:
+                self.rows[key] = [] if self.many else None
+            for row in (yield select.sql(), select.parameters).fetch_all():
+                if self.many:
+                    self.rows.setdefault(row[column], []).append(row)
+                else:
+                    self.rows[row[column]] = row
+
+
+class LoaderResult(object):
+
+    """
+    Result of a key requested to a loader, selected when it is read
+    """
+
+    def __init__(self, loader, key):
+        self.key = key
+        self.loader = loader
+
+    def get(self):
+        """
+        Get the rows of the key, selecting the keys requested to the loader when it was not loaded yet
+        :return: Row or list of rows, None or empty list when not found
+        """
+        return self.loader.get(self.key)
+
 
 class Page(dict):
 
@@ -129,11 +1011,247 @@ class Page(dict):
     Page object
     """
 
-    def __init__(self, number, size, data, last):
+    def __init__(self, number, size, data, last, cursor=None, total=None):
+        self['cursor'] = self.cursor = cursor
         self['data'] = self.data = data
         self['last'] = self.last = last
         self['number'] = self.number = number
         self['size'] = self.size = size
+        self['total'] = self.total = total
+        self['total_pages'] = self.total_pages = -(-total // size) if total is not None else None
+
+    @staticmethod
+    def pop_total(data):
+        """
+        Remove the total computed by the window function from the rows
+        :param data: Rows
+        :return: Total, None when there are no rows
+        """
+        total = None
+        for row in data:
+            total = row.pop('paging_total')
+        return total
+
+
+class PreparedStatementCache(object):
+
+    """
+    LRU cache of the statements prepared in a connection
+    """
+
+    caches = weakref.WeakKeyDictionary()
+
+    def __init__(self, size):
+        self.size = size
+        self.stale = set()
+        self.statements = collections.OrderedDict()
+        self.unpreparable = set()
+
+    def clear(self):
+        """
+        Forget the prepared statements, after they were deallocated
+        :return: None
+        """
+        self.stale.clear()
+        self.statements.clear()
+        self.unpreparable.clear()
+
+    @staticmethod
+    def connection(connection, size):
+        """
+        Get the cache of a connection, a reconnection creates a new connection and so an empty cache
+        :param connection: Psycopg connection
+        :param size: Maximum number of prepared statements
+        :return: Prepared statement cache
+        """
+        cache = PreparedStatementCache.caches.get(connection)
+        if cache is None:
+            cache = PreparedStatementCache.caches[connection] = PreparedStatementCache(size)
+        return cache
+
+    def execute(self, cursor, sql, parameters):
+        """
+        Execute SQL with a prepared statement, preparing it on first use; a statement failing to prepare, as with a
+        tuple adapted by psycopg, is rolled back to a savepoint and executed without preparing it
+        :param cursor: Cursor
+        :param sql: SQL string
+        :param parameters: SQL parameters
+        :return: None
+        """
+        template = PreparedStatementCache.template(sql)
+        if template is None or template[0] in self.unpreparable:
+            cursor.execute(sql, parameters)
+            return
+        name, statement, fields = template
+        while len(self.stale) > 0:
+            cursor.execute('deallocate {}'.format(self.stale.pop()))
+        if name in self.statements:
+            self.statements.move_to_end(name)
+        else:
+            cursor.execute('savepoint py_postgresql_wrapper_prepare')
+            try:
+                cursor.execute('prepare {} as {}'.format(name, statement))
+            except psycopg2.Error:
+                cursor.execute('rollback to savepoint py_postgresql_wrapper_prepare')
+                cursor.execute('release savepoint py_postgresql_wrapper_prepare')
+                self.unpreparable.add(name)
+                cursor.execute(sql, parameters)
+                return
+            cursor.execute('release savepoint py_postgresql_wrapper_prepare')
+            self.statements[name] = statement
+            if len(self.statements) > self.size:
+                cursor.execute('deallocate {}'.format(self.statements.popitem(last=False)[0]))
+        if fields is not None:
+            values = [parameters[field] for field in fields]
+        else:
+            values = [] if isinstance(parameters, dict) else list(parameters)
+        try:
+            if len(values) > 0:
+                cursor.execute('execute {} ({})'.format(name, ', '.join(['%s'] * len(values))), values)
+            else:
+                cursor.execute('execute {}'.format(name))
+        except psycopg2.errors.InvalidSqlStatementName:
+            self.clear()
+            raise
+        except psycopg2.errors.FeatureNotSupported:
+            self.statements.pop(name, None)
+            self.stale.add(name)
+            raise
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def template(sql):
+        """
+        Compile SQL with psycopg placeholders into a statement with positional parameters
+        :param sql: SQL string
+        :return: Statement name, statement and parameter names, None when it can not be prepared
+        """
+        if PREPARABLE_PATTERN.match(sql) is None:
+            return None
+        fields = []
+        positional = []
+
+        def replace(match):
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                positional.append(None)
+                return '${}'.format(len(positional))
+            if match.group(1) not in fields:
+                fields.append(match.group(1))
+            return '${}'.format(fields.index(match.group(1)) + 1)
+
+        statement = PARAMETER_PATTERN.sub(replace, sql)
+        if len(fields) > 0 and len(positional) > 0:
+            return None
+        name = 'py_postgresql_wrapper_{}'.format(hashlib.sha1(sql.encode('utf-8')).hexdigest()[:24])
+        return name, statement, fields if len(fields) > 0 else None
+
+
+class QueryRegistry(object):
+
+    """
+    Registry of the queries located in the queries directory, loaded once in memory
+    """
+
+    __instance__ = None
+
+    def __init__(self, directory=None, reload=False):
+        self.directory = QUERIES_DIRECTORY if directory is None else directory
+        self.queries = {}
+        self.reload = reload
+        self.scan()
+
+    def get(self, name):
+        """
+        Get a query by name, a name not registered is an inline query
+        :param name: File name or inline query
+        :return: Query as a string
+        """
+        query = self.queries.get(name)
+        if not self.reload:
+            return name if query is None else query[0]
+        if query is None:
+            if QUERY_NAME_PATTERN.match(name) is None:
+                return name
+            try:
+                return self.load(name)
+            except IOError as exception:
+                if exception.errno == errno.ENOENT:
+                    return name
+                raise exception
+        try:
+            if os.stat(self.path(name)).st_mtime_ns != query[1]:
+                return self.load(name)
+        except IOError as exception:
+            if exception.errno == errno.ENOENT:
+                del self.queries[name]
+                return name
+            raise exception
+        return query[0]
+
+    @staticmethod
+    def instance(directory=None, reload=False):
+        """
+        Get singleton instance of query registry
+        :param directory: Queries directory
+        :param reload: Reload the queries changed on disk
+        :return: Query registry instance
+        """
+        if QueryRegistry.__instance__ is None:
+            QueryRegistry.__instance__ = QueryRegistry(directory, reload)
+        return QueryRegistry.__instance__
+
+    def load(self, name):
+        """
+        Load a query file in the registry
+        :param name: File name
+        :return: Query as a string
+        """
+        path = self.path(name)
+        with open(path) as file:
+            mtime = os.fstat(file.fileno()).st_mtime_ns
+            query = file.read()
+        self.queries[name] = (query, mtime)
+        return query
+
+    def path(self, name):
+        """
+        Path of a query file
+        :param name: File name
+        :return: Path
+        """
+        return os.path.join(self.directory, name + '.sql')
+
+    def scan(self):
+        """
+        Load all query files of the queries directory
+        :return: None
+        """
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith('.sql'):
+                    name = os.path.relpath(os.path.join(root, file), self.directory)[:-len('.sql')]
+                    self.load(name.replace(os.sep, '/'))
+
+
+class UpsertResult(dict):
+
+    """
+    Upsert result object
+    """
+
+    def __init__(self, inserted, updated):
+        self['inserted'] = self.inserted = inserted
+        self['row_count'] = inserted + updated
+        self['updated'] = self.updated = updated
+
+    def row_count(self):
+        """
+        Number of rows inserted or updated
+        :return: Row count
+        """
+        return self['row_count']
 
 
 # Builders
@@ -144,17 +1262,150 @@ class SQLBuilder(object):
     """
 
     def __init__(self, database, table):
+        self.batch_size = 1000
+        self.bulk_rows = None
         self.database = database
+        self.execution_timeout = None
+        self.notifications = []
         self.parameters = {}
         self.table = table
+        self.where_clauses = []
         self.where_conditions = []
 
+    def batches(self):
+        """
+        Group the rows in batches of batch size
+        :return: Generator of columns and parameters of each batch
+        """
+        iterator = iter(self.bulk_rows)
+        columns = None
+        while True:
+            batch = list(itertools.islice(iterator, self.batch_size))
+            if len(batch) == 0:
+                return
+            parameters = []
+            for row in batch:
+                data = dict(self.parameters)
+                data.update(row)
+                if columns is None:
+                    columns = list(data.keys())
+                elif len(data) != len(columns) or any(field not in data for field in columns):
+                    raise ValueError('All rows must have the same keys')
+                parameters.extend(data[field] for field in columns)
+            yield columns, len(batch), parameters
+
+    def bulk_from_build(self, columns, size, types):
+        """
+        Construction of the batch rows joined by update and delete, each value cast to the type of its table column
+        :param columns: Parameter columns, possibly qualified by the table alias
+        :param size: Number of rows
+        :param types: Dict of table column and type
+        :return: Batch rows command
+        """
+        unknown = [field for field in columns if field not in self.parameters]
+        if len(unknown) > 0:
+            raise ValueError('{} are not fields with values of the builder'.format(', '.join(unknown)))
+        if not any(not constant for _, _, _, constant in self.where_clauses):
+            raise ValueError('Batch execution requires where fields with values')
+        names = [field.split('.')[-1] for field in columns]
+        missing = [name for name in names if name not in types]
+        if len(missing) > 0:
+            raise ValueError('{} are not columns of {}'.format(', '.join(missing), self.table.split()[0]))
+        values = '({})'.format(', '.join('%s::{}'.format(types[name]) for name in names))
+        return '(values {}) as batch ({})'.format(', '.join([values] * size), ', '.join(names))
+
+    def bulk_sql(self, columns, size, types=None):
+        """
+        Construction of the command for a batch of rows
+        :param columns: Parameter columns
+        :param size: Number of rows
+        :param types: Dict of table column and type, for the batch rows joined by update and delete
+        :return: None
+        """
+        pass
+
+    def bulk_statements(self):
+        """
+        Statements executing the rows in batches
+        :return: Generator of statements returning the batch result
+        """
+        counts = []
+        data = []
+        types = None
+        for columns, size, parameters in self.batches():
+            if types is None and self.bulk_typed():
+                types = yield from self.bulk_types_statements()
+            cursor = yield self.bulk_sql(columns, size, types), parameters
+            counts.append(cursor.row_count())
+            if cursor.cursor.description is not None:
+                data.extend(cursor.fetch_all())
+            cursor.close()
+        return BatchResult(counts, data)
+
+    def bulk_typed(self):
+        """
+        Batch rows are joined and so typed as the table columns
+        :return: True
+        """
+        return True
+
+    def bulk_types_statements(self):
+        """
+        Statements reading the types of the table columns, without their modifiers as a cast to varchar(n) truncates
+        the values that the assignment rejects
+        :return: Generator of statements returning a dict of column and type
+        """
+        cursor = yield (
+            'select attname as name, format_type(atttypid, null) as type from pg_attribute '
+            'where attrelid = %(table)s::regclass and attnum > 0 and not attisdropped'
+        ), {'table': self.table.split()[0]}
+        return {row['name']: row['type'] for row in cursor.fetch_all()}
+
+    def deferrable(self):
+        """
+        Execution can be deferred
+        :return: True
+        """
+        return True
+
     def execute(self):
         """
-        Execute SQL
-        :return: Return of execution of SQL code in the database
+        Execute SQL, in batches when rows were given, invalidating the cached rows of the table on commit; in a deferred
+        database a single statement is queued until the next flush
+        :return: Cursor, batch result or deferred result
+        """
+        self.database.invalidate(self.table)
+        if self.bulk_rows is None:
+            if self.database.deferred and self.execution_timeout is None and self.deferrable():
+                result = self.database.defer(self.sql(), self.parameters)
+            else:
+                result = self.database.execute(self.sql(), self.parameters, True, timeout=self.execution_timeout, prepare=True)
+        else:
+            result = self.database.run(self.bulk_statements(), timeout=self.execution_timeout, prepare=True)
+        if len(self.notifications) > 0:
+            return self.database.notify_after(result, self.notifications)
+        return result
+
+    def notify(self, channel, payload=None):
+        """
+        Notify a channel after the execution, the notification is delivered when the transaction is committed
+        :param channel: Channel name
+        :param payload: Payload string, or a dict or list encoded in JSON
+        :return: Self
         """
-        return self.database.execute(self.sql(), self.parameters, True)
+        self.notifications.append((channel, payload))
+        return self
+
+    def rows(self, data, batch_size=1000):
+        """
+        Set rows executed in batches, each one with the values of the builder fields
+        :param data: Iterable of dicts
+        :param batch_size: Number of rows by statement
+        :return: Self
+        """
+        self.batch_size = batch_size
+        self.bulk_rows = data
+        return self
 
     def sql(self):
         """
@@ -163,6 +1414,15 @@ class SQLBuilder(object):
         """
         pass
 
+    def timeout(self, seconds):
+        """
+        Set the time limit of the execution
+        :param seconds: Time limit in seconds, for all the batches when rows were given
+        :return: Self
+        """
+        self.execution_timeout = seconds
+        return self
+
     def where_all(self, data):
         """
         Construction of the command for where all
@@ -184,6 +1444,21 @@ class SQLBuilder(object):
         else:
             return ''
 
+    def where_bulk_build(self):
+        """
+        Construction of the command for where, joining the table to the batch rows
+        :return: Where command
+        """
+        alias = self.table.split()[-1]
+        conditions = []
+        for field, operator, value, constant in self.where_clauses:
+            field = field.split('.')[-1]
+            if constant:
+                conditions.append('{}.{} {} {}'.format(alias, field, operator, value))
+            else:
+                conditions.append('{0}.{1} {2} batch.{1}'.format(alias, field, operator))
+        return 'where {}'.format(' and '.join(conditions))
+
     def where(self, field, value, constant=False, operator='='):
         """
         Construction of the command for where conditions
@@ -198,6 +1473,7 @@ class SQLBuilder(object):
         else:
             self.parameters[field] = value
             self.where_conditions.append('{0} {1} %({0})s'.format(field, operator))
+        self.where_clauses.append((field, operator, value, constant))
         return self
 
 
@@ -207,6 +1483,16 @@ class DeleteBuilder(SQLBuilder):
     Delete constructor
     """
 
+    def bulk_sql(self, columns, size, types=None):
+        """
+        Construction of the command for a batch of deletes, joined to the batch rows
+        :param columns: Parameter columns
+        :param size: Number of rows
+        :param types: Dict of table column and type
+        :return: Delete SQL string
+        """
+        return 'delete from {} using {} {}'.format(self.table, self.bulk_from_build(columns, size, types), self.where_bulk_build())
+
     def sql(self):
         """
         Construction of the command for data delete
@@ -223,7 +1509,91 @@ class InsertBuilder(SQLBuilder):
 
     def __init__(self, database, table):
         super(InsertBuilder, self).__init__(database, table)
+        self.conflict_fields = []
+        self.conflict_update = None
         self.constants = {}
+        self.returning_fields = []
+
+    def bulk_sql(self, columns, size, types=None):
+        """
+        Construction of the command for multi-row data entry
+        :param columns: Parameter columns
+        :param size: Number of rows
+        :param types: Not used, the values are typed by the insert
+        :return: Insert SQL string
+        """
+        if len(set(columns) & set(self.constants.keys())) > 0:
+            raise ValueError('There are repeated keys in constants and values')
+        values = '({})'.format(', '.join([str(value) for value in self.constants.values()] + ['%s'] * len(columns)))
+        return 'insert into {} ({}) values {} {} {}'.format(
+            self.table,
+            ', '.join(list(self.constants.keys()) + columns),
+            ', '.join([values] * size),
+            self.on_conflict_build(list(self.constants.keys()) + columns),
+            self.returning_build()
+        )
+
+    def bulk_typed(self):
+        """
+        Batch rows are values of the insert, typed by the insert itself
+        :return: False
+        """
+        return False
+
+    def deferrable(self):
+        """
+        Execution can be deferred when no fields are returned
+        :return: True when there are no returning fields
+        """
+        return len(self.returning_fields) == 0
+
+    def on_conflict(self, *fields, update=None):
+        """
+        Set conflict fields, updating the row when it already exists
+        :param fields: Conflict fields, of a unique index
+        :param update: Fields updated on conflict, by default all other fields, none to skip the conflicting rows
+        :return: Self
+        """
+        self.conflict_fields = fields
+        self.conflict_update = update
+        return self
+
+    def on_conflict_build(self, columns):
+        """
+        Construction of the command for on conflict
+        :param columns: Inserted columns
+        :return: On conflict command
+        """
+        if len(self.conflict_fields) == 0:
+            return ''
+        update = self.conflict_update
+        if update is None:
+            update = [field for field in columns if field not in self.conflict_fields]
+        if len(update) == 0:
+            return 'on conflict ({}) do nothing'.format(', '.join(self.conflict_fields))
+        return 'on conflict ({}) do update set {}'.format(
+            ', '.join(self.conflict_fields),
+            ', '.join('{0} = excluded.{0}'.format(field) for field in update)
+        )
+
+    def returning(self, *fields):
+        """
+        Set returning fields
+        :param fields: Returning fields
+        :return: Self
+        """
+        self.returning_fields = fields
+        return self
+
+    def returning_build(self):
+        """
+        Construction of the command for returning
+        :return: Returning command
+        """
+        if len(self.returning_fields) > 0:
+            return 'returning {}'.format(', '.join(self.returning_fields))
+        else:
+            return ''
 
     def set(self, field, value, constant=False):
         """
@@ -263,7 +1633,13 @@ class InsertBuilder(SQLBuilder):
             for field in self.parameters:
                 columns.append(field)
                 values.append('%({})s'.format(field))
-            return 'insert into {} ({}) values ({})'.format(self.table, ', '.join(columns), ', '.join(values))
+            return 'insert into {} ({}) values ({}) {} {}'.format(
+                self.table,
+                ', '.join(columns),
+                ', '.join(values),
+                self.on_conflict_build(columns),
+                self.returning_build()
+            )
         else:
             raise ValueError('There are repeated keys in constants and values')
 
@@ -276,10 +1652,34 @@ class SelectBuilder(SQLBuilder):
 
     def __init__(self, database, table):
         super(SelectBuilder, self).__init__(database, table)
+        self.select_cache = None
         self.select_fields = ['*']
         self.select_group_by = []
         self.select_order_by = []
         self.select_page = ''
+        self.select_row_format = 'wrapper'
+        self.select_tags = [table]
+
+    def cache(self, ttl=None, tags=None):
+        """
+        Cache the selected rows, invalidated when the table is written
+        :param ttl: Time to live in seconds, by default the TTL of the configuration
+        :param tags: Other tables read by the select, as the joined tables
+        :return: Self
+        """
+        self.select_cache = True if ttl is None else ttl
+        self.select_tags = [self.table] + list(tags or [])
+        return self
+
+    def copy_out(self, sink=None, format='csv', header=True):
+        """
+        Export the selected data with copy to stdout
+        :param sink: File-like object to write into, when not given the data is returned as a stream of bytes chunks
+        :param format: Copy format, csv, text or binary
+        :param header: Write a header line, for csv format
+        :return: Cursor when a sink was given, else a stream of bytes chunks
+        """
+        return self.database.copy_out(self.sql(), self.parameters, sink, format, header, True, replica=True)
 
     def fields(self, *fields):
         """
@@ -308,17 +1708,140 @@ class SelectBuilder(SQLBuilder):
         self.select_order_by = fields
         return self
 
-    def paging(self, page=0, size=10):
+    def paging(self, page=0, size=10, cursor=None, keyset=False, count=None, timeout=None):
         """
-        Pagination
+        Pagination, by offset or by keyset over the order by fields
         :param page: Page number
         :param size: Page size
+        :param cursor: Cursor of the previous page, for keyset pagination
+        :param keyset: Keyset pagination
+        :param count: Total count strategy, exact, window or estimate
+        :param timeout: Time limit in seconds for the page and its count, by default the timeout of the builder
         :return: Page
         """
-        self.select_page = 'limit {} offset {}'.format(size + 1, page * size)
-        data = self.execute().fetch_all()
+        timeout = self.execution_timeout if timeout is None else timeout
+        return self.database.run(self.paging_statements(page, size, cursor, keyset, count), True, timeout, True)
+
+    def paging_statements(self, page=0, size=10, cursor=None, keyset=False, count=None):
+        """
+        Statements selecting a page
+        :param page: Page number
+        :param size: Page size
+        :param cursor: Cursor of the previous page, for keyset pagination
+        :param keyset: Keyset pagination
+        :param count: Total count strategy, exact, window or estimate
+        :return: Generator of statements returning the page
+        """
+        keyset = keyset or cursor is not None
+        total = None
+        if count is not None and (count != 'exact' or keyset):
+            table = self.table if len(self.where_conditions) == 0 and len(self.select_group_by) == 0 else None
+            total = yield from Database.count_statements(self.sql(), self.parameters, count, (page + COUNT_WINDOW) * size + 1, table)
+        select = copy.copy(self)
+        select.parameters = dict(self.parameters)
+        select.where_clauses = list(self.where_clauses)
+        select.where_conditions = list(self.where_conditions)
+        if keyset:
+            keyset = Keyset(self.select_order_by)
+            if cursor is not None:
+                placeholders = []
+                for index, value in enumerate(Keyset.decode(cursor)):
+                    select.parameters['keyset_{}'.format(index)] = value
+                    placeholders.append('%(keyset_{})s'.format(index))
+                select.where_conditions.append(keyset.condition(placeholders))
+            select.select_page = 'limit {}'.format(size + 1)
+        else:
+            keyset = None
+            if count == 'exact':
+                select.select_fields = list(self.select_fields) + ['count(*) over() as paging_total']
+            select.select_page = 'limit {} offset {}'.format(size + 1, page * size)
+        data = (yield select.sql(), select.parameters).fetch_all()
+        if count == 'exact' and keyset is None:
+            total = Page.pop_total(data)
+            if total is None:
+                total = 0 if page == 0 else (yield from Database.count_statements(self.sql(), self.parameters))
         last = len(data) <= size
-        return Page(page, size, data[:-1] if not last else data, last)
+        data = data[:-1] if not last else data
+        return Page(page, size, data, last, keyset.encode(data[-1]) if keyset is not None and not last else None, total)
+
+    def execute(self):
+        """
+        Execute SQL, in a replica when replicas are configured
+        :return: Return of execution of SQL code in the database
+        """
+        return self.database.execute(
+            self.sql(), self.parameters, True, True, self.select_cache, self.select_tags, self.select_row_format,
+            self.execution_timeout, True
+        )
+
+    def row_format(self, row_format):
+        """
+        Set the format of the executed and streamed rows
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :return: Self
+        """
+        Database.cursor_factory(row_format)
+        self.select_row_format = row_format
+        return self
+
+    def scan(self, partitions=4, key=None, ordered=False, chunk_size=1000, function=None, processes=None, queue_size=4, workers=None):
+        """
+        Scan the selected rows in partitions by ranges of an integer key or by ctid block ranges, each one streamed concurrently in its own pooled connection
+        :param partitions: Number of partitions
+        :param key: Integer column splitting the rows in ranges, by default the physical blocks of the table
+        :param ordered: Rows ordered by the key or by physical location, else in arrival order
+        :param chunk_size: Number of rows fetched from the server at once
+        :param function: Function applied to each row in a process pool, it and the rows must be picklable
+        :param processes: Number of processes of the pool, by default the number of CPUs
+        :param queue_size: Number of chunks buffered by partition
+        :param workers: Maximum number of partitions streamed concurrently, by default up to the free connections of the pool
+        :return: Parallel scan, iterator of rows
+        """
+        if partitions < 1:
+            raise ValueError('{} is not a valid number of partitions'.format(partitions))
+        alias = self.table.split()[-1]
+        if key is None:
+            field = '{}.ctid'.format(alias)
+            low = 0
+            high = self.database.execute(
+                'select pg_relation_size(%(table)s::regclass) / current_setting(\'block_size\')::int as blocks',
+                {'table': self.table.split()[0]}, True, True
+            ).fetch_one()['blocks']
+            bound = '\'({},0)\'::tid'
+        else:
+            field = key
+            data = self.database.execute(
+                'select min({0}) as low, max({0}) as high from {1} {2}'.format(key, self.table, self.where_build()),
+                self.parameters, True, True
+            ).fetch_one()
+            low, high = data['low'], data['high']
+            if low is not None and not isinstance(low, int):
+                raise ValueError('{} is not an integer column'.format(key))
+            high = None if high is None else high + 1
+            bound = '{}'
+        statements = []
+        if high is None or high <= low:
+            ranges = [(None, None)]
+        else:
+            step = max(1, -(-(high - low) // partitions))
+            ranges = [(start, start + step) for start in range(low, high, step)]
+            ranges[0] = (None, ranges[0][1])
+            ranges[-1] = (ranges[-1][0], None)
+        for start, end in ranges:
+            partition = copy.copy(self)
+            partition.parameters = dict(self.parameters)
+            partition.select_order_by = [field] if ordered else []
+            partition.where_clauses = list(self.where_clauses)
+            partition.where_conditions = list(self.where_conditions)
+            if start is not None:
+                partition.where(field, bound.format(start), True, '>=')
+            if end is not None:
+                partition.where(field, bound.format(end), True, '<')
+            statements.append((partition.sql(), partition.parameters))
+        return ParallelScan(
+            self.database.configuration, statements, ordered, chunk_size, self.select_row_format,
+            function, processes, queue_size, self.database.replica, workers
+        )
 
     def sql(self):
         """
@@ -340,6 +1863,14 @@ class SelectBuilder(SQLBuilder):
             self.select_page
         )
 
+    def stream(self, chunk_size=1000):
+        """
+        Execute SQL with a server-side cursor, fetching the rows in chunks
+        :param chunk_size: Number of rows fetched from the server at once
+        :return: Cursor
+        """
+        return self.database.stream(self.sql(), self.parameters, chunk_size, True, True, self.select_row_format)
+
 
 class UpdateBuilder(SQLBuilder):
 
@@ -349,8 +1880,24 @@ class UpdateBuilder(SQLBuilder):
 
     def __init__(self, database, table):
         super(UpdateBuilder, self).__init__(database, table)
+        self.set_clauses = []
         self.statements = []
 
+    def bulk_sql(self, columns, size, types=None):
+        """
+        Construction of the command for a batch of updates, joined to the batch rows
+        :param columns: Parameter columns
+        :param size: Number of rows
+        :param types: Dict of table column and type
+        :return: Update SQL string
+        """
+        return 'update {} {} from {} {}'.format(
+            self.table,
+            self.set_bulk_build(),
+            self.bulk_from_build(columns, size, types),
+            self.where_bulk_build()
+        )
+
     def set(self, field, value, constant=False):
         """
         Set constants or parameters
@@ -364,6 +1911,7 @@ class UpdateBuilder(SQLBuilder):
         else:
             self.statements.append('{0} = %({0})s'.format(field))
             self.parameters[field] = value
+        self.set_clauses.append((field, value, constant))
         return self
 
     def set_all(self, data):
@@ -387,6 +1935,19 @@ class UpdateBuilder(SQLBuilder):
         else:
             return ''
 
+    def set_bulk_build(self):
+        """
+        Construction of the command for set, from the batch rows
+        :return: Set command
+        """
+        statements = []
+        for field, value, constant in self.set_clauses:
+            if constant:
+                statements.append('{} = {}'.format(field, value))
+            else:
+                statements.append('{0} = batch.{0}'.format(field))
+        return 'set {}'.format(', '.join(statements))
+
     def sql(self):
         """
         Construction of the command for data update
@@ -402,8 +1963,12 @@ class CursorWrapper(object):
     Cursor wrapper to access cursor functions
     """
 
-    def __init__(self, cursor):
+    def __init__(self, cursor, chunk_size=1000, row_format='wrapper'):
+        self.buffer = collections.deque()
+        self.chunk_size = chunk_size
+        self.columns = None
         self.cursor = cursor
+        self.row_format = row_format
 
     def __iter__(self):
         return self
@@ -411,6 +1976,15 @@ class CursorWrapper(object):
     def __next__(self):
         return self.next()
 
+    def buffered(self, size=None):
+        """
+        Take the rows read ahead by the iteration, fetched before the rows left in the cursor
+        :param size: Maximum number of rows, by default all of them
+        :return: Formatted rows
+        """
+        count = len(self.buffer) if size is None else min(size, len(self.buffer))
+        return [self.buffer.popleft() for _ in range(count)]
+
     def close(self):
         """
         Close a cursor structure
@@ -423,7 +1997,30 @@ class CursorWrapper(object):
         Fetch all record by the cursor
         :return: All data
         """
-        return [DictWrapper(row) for row in self.cursor.fetchall()]
+        return self.buffered() + self.rows(self.cursor.fetchall())
+
+    def fetch_columns(self):
+        """
+        Fetch all record by the cursor as columns, built in chunks of chunk size
+        :return: Dict of column name and NumPy array, masked where there are nulls
+        """
+        import numpy
+        chunks = []
+        while True:
+            chunk = self.fetch_many_columns(self.chunk_size)
+            chunks.append(chunk)
+            if len(chunk) == 0 or len(next(iter(chunk.values()))) < self.chunk_size:
+                break
+        if len(chunks) == 1:
+            return chunks[0]
+        return {
+            column: (
+                numpy.ma.concatenate([chunk[column] for chunk in chunks])
+                if any(numpy.ma.isMaskedArray(chunk[column]) for chunk in chunks)
+                else numpy.concatenate([chunk[column] for chunk in chunks])
+            )
+            for column in chunks[0]
+        }
 
     def fetch_many(self, size):
         """
@@ -431,29 +2028,75 @@ class CursorWrapper(object):
         :param size: Size number
         :return: Many data
         """
-        return [DictWrapper(row) for row in self.cursor.fetchmany(size)]
+        rows = self.buffered(size)
+        if len(rows) < size:
+            rows.extend(self.rows(self.cursor.fetchmany(size - len(rows))))
+        return rows
+
+    def fetch_many_columns(self, size):
+        """
+        Fetch many record by the cursor as columns, typed by the column type of the result description
+        :param size: Size number
+        :return: Dict of column name and NumPy array, masked where there are nulls
+        """
+        import numpy
+        rows = self.buffered(size)
+        if len(rows) < size:
+            rows.extend(self.cursor.fetchmany(size - len(rows)))
+        if self.columns is None:
+            self.columns = tuple(column[0] for column in self.cursor.description)
+        rows = [tuple(row[column] for column in self.columns) if isinstance(row, dict) else row for row in rows]
+        values = list(zip(*rows)) if len(rows) > 0 else [()] * len(self.columns)
+        data = {}
+        for column, description, items in zip(self.columns, self.cursor.description, values):
+            dtype = numpy.dtype(COLUMN_TYPES.get(description[1], 'object'))
+            mask = [item is None for item in items]
+            if dtype.kind == 'O':
+                array = numpy.empty(len(items), dtype)
+                array[:] = items
+            elif any(mask):
+                fill = numpy.zeros((), dtype).item()
+                array = numpy.array([fill if item is None else item for item in items], dtype=dtype)
+            else:
+                array = numpy.array(items, dtype=dtype)
+            data[column] = numpy.ma.array(array, mask=mask) if any(mask) else array
+        return data
 
     def fetch_one(self):
         """
         Fetch one record by the cursor
         :return: Row data
         """
+        if len(self.buffer) > 0:
+            return self.buffer.popleft()
         row = self.cursor.fetchone()
         if row is not None:
-            return DictWrapper(row)
+            return self.rows([row])[0]
         else:
             self.close()
         return row
 
     def next(self):
         """
-        Return the next record by the cursor
+        Return the next record by the cursor, fetching the records in chunks
         :return: Row data
         """
-        row = self.fetch_one()
-        if row is None:
-            raise StopIteration()
-        return row
+        if len(self.buffer) == 0:
+            self.buffer.extend(self.rows(self.cursor.fetchmany(self.chunk_size)))
+            if len(self.buffer) == 0:
+                self.close()
+                raise StopIteration()
+        return self.buffer.popleft()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def record(columns):
+        """
+        Record class of columns, a tuple with attribute access and no dict by row
+        :param columns: Column names
+        :return: Record class
+        """
+        return collections.namedtuple('Record', columns, rename=True)
 
     def row_count(self):
         """
@@ -462,6 +2105,23 @@ class CursorWrapper(object):
         """
         return self.cursor.rowcount
 
+    def rows(self, rows):
+        """
+        Format rows fetched by the cursor, the columns are read once from the cursor description
+        :param rows: Rows
+        :return: Formatted rows
+        """
+        if self.row_format == 'wrapper':
+            return [DictWrapper(row) for row in rows]
+        if self.row_format == 'tuple':
+            return rows
+        if self.columns is None:
+            self.columns = tuple(column[0] for column in self.cursor.description)
+        if self.row_format == 'record':
+            return list(map(CursorWrapper.record(self.columns)._make, rows))
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in rows]
+
 
 class DictWrapper(dict):
 
@@ -488,3 +2148,644 @@ class DictWrapper(dict):
         :return: Self
         """
         return self
+
+
+# Streams
+class CopyOutStream(object):
+
+    """
+    Iterator of bytes chunks produced by copy to stdout, read in a background thread through a bounded queue
+    """
+
+    def __init__(self, cursor, sql, buffer_size=65536, queue_size=16):
+        self.closed = False
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, args=(cursor, sql, buffer_size), daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration()
+        data = self.queue.get()
+        if data is None:
+            self.close()
+            raise StopIteration()
+        if isinstance(data, Exception):
+            self.close()
+            raise data
+        return data
+
+    def close(self):
+        """
+        Stop the copy, discarding the data not read yet
+        :return: None
+        """
+        self.closed = True
+        while self.thread.is_alive():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.thread.join(0.01)
+
+    def run(self, cursor, sql, buffer_size):
+        """
+        Run the copy, writing the chunks in the queue
+        :param cursor: Cursor
+        :param sql: Copy SQL string
+        :param buffer_size: Size of the chunks read from the server
+        :return: None
+        """
+        try:
+            cursor.copy_expert(sql, self, buffer_size)
+            self.put(None)
+        except Exception as exception:
+            self.put(exception)
+        finally:
+            cursor.close()
+
+    def put(self, data):
+        """
+        Put data in the queue, giving up when the stream is closed
+        :param data: Bytes, None at the end of the copy or exception
+        :return: True when the data was put
+        """
+        while not self.closed:
+            try:
+                self.queue.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write(self, data):
+        """
+        Write a chunk in the queue
+        :param data: Bytes
+        :return: None
+        """
+        if not self.put(bytes(data)):
+            raise IOError('Copy stream was closed')
+
+
+class CopyInStream(object):
+
+    """
+    File-like object encoding rows for copy from stdin as they are read
+    """
+
+    def __init__(self, rows, columns=None, format='text'):
+        if format not in ('binary', 'text'):
+            raise ValueError('{} is not a valid copy format'.format(format))
+        self.buffer = bytearray(COPY_BINARY_HEADER if format == 'binary' else b'')
+        self.columns = columns
+        self.finished = False
+        self.format = format
+        self.rows = iter(rows)
+
+    def encode(self, row):
+        """
+        Encode a row in the copy format
+        :param row: Dict or tuple
+        :return: Row as bytes
+        """
+        if isinstance(row, dict):
+            row = [row[field] for field in self.columns] if self.columns is not None else list(row.values())
+        if self.format == 'binary':
+            return self.encode_binary(row)
+        return ('\t'.join(self.encode_text(value) for value in row) + '\n').encode('utf-8')
+
+    @staticmethod
+    def encode_binary(row):
+        """
+        Encode a row in the binary copy format, values must be bytes in the binary format of the column or str
+        :param row: Row values
+        :return: Row as bytes
+        """
+        data = bytearray(struct.pack('!h', len(row)))
+        for value in row:
+            if value is None:
+                data += struct.pack('!i', -1)
+                continue
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            elif not isinstance(value, (bytes, bytearray, memoryview)):
+                raise ValueError('Binary copy requires bytes or str values, got {}'.format(type(value).__name__))
+            data += struct.pack('!i', len(value))
+            data += value
+        return bytes(data)
+
+    @staticmethod
+    def encode_element(value):
+        """
+        Encode an element of an array literal, quoted unless it is null or a nested array
+        :param value: Value
+        :return: Element as string
+        """
+        if value is None:
+            return 'NULL'
+        if isinstance(value, list):
+            return CopyInStream.encode_literal(value)
+        return '"{}"'.format(CopyInStream.encode_literal(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+    @staticmethod
+    def encode_literal(value):
+        """
+        Encode a value as a PostgreSQL literal, lists as array literals and dicts in JSON
+        :param value: Value, not null
+        :return: Literal as string
+        """
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return '\\x' + bytes(value).hex()
+        if isinstance(value, dict):
+            return json.dumps(value, default=str)
+        if isinstance(value, list):
+            return '{{{}}}'.format(','.join(CopyInStream.encode_element(item) for item in value))
+        return str(value)
+
+    @staticmethod
+    def encode_text(value):
+        """
+        Encode a value in the text copy format
+        :param value: Value
+        :return: Value as string
+        """
+        if value is None:
+            return '\\N'
+        literal = CopyInStream.encode_literal(value)
+        return literal.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+    def read(self, size=-1):
+        """
+        Read encoded rows, pulling from the rows only what is needed to fill the size
+        :param size: Number of bytes
+        :return: Bytes
+        """
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            row = next(self.rows, None)
+            if row is None:
+                self.finished = True
+                if self.format == 'binary':
+                    self.buffer += COPY_BINARY_TRAILER
+            else:
+                self.buffer += self.encode(row)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class ParallelScan(object):
+
+    """
+    Iterator of the rows of partitions streamed concurrently by a bounded number of background threads, each one in its
+    own pooled connection, through bounded queues
+    """
+
+    def __init__(self, configuration, statements, ordered=False, chunk_size=1000, row_format='wrapper', function=None, processes=None, queue_size=4, replica=True, workers=None):
+        self.closed = False
+        self.function = function
+        self.ordered = ordered
+        self.partitions = queue.Queue()
+        self.processes = processes or os.cpu_count() or 1
+        self.queues = [queue.Queue(queue_size) for _ in statements] if ordered else [queue.Queue(queue_size * len(statements))]
+        self.remaining = len(statements)
+        self.threads = []
+        for index, (sql, parameters) in enumerate(statements):
+            self.partitions.put((sql, parameters, self.queues[index if ordered else 0]))
+        if workers is None:
+            workers = ParallelScan.workers(configuration, replica, len(statements))
+        for _ in range(max(1, min(workers, len(statements)))):
+            thread = threading.Thread(target=self.run, args=(configuration, replica, chunk_size, row_format), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.iterator = self.rows()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    @staticmethod
+    def apply(function, rows):
+        """
+        Apply a function to rows, in a worker process
+        :param function: Function
+        :param rows: Rows
+        :return: List of results
+        """
+        return [function(row) for row in rows]
+
+    def chunks(self):
+        """
+        Chunks of rows of the partitions, in partition order when ordered, else in arrival order
+        :return: Generator of lists of rows
+        """
+        remaining = self.remaining
+        for output in self.queues:
+            while remaining > 0:
+                data = output.get()
+                if isinstance(data, Exception):
+                    raise data
+                if data is None:
+                    remaining -= 1
+                    if self.ordered:
+                        break
+                    continue
+                yield data
+
+    def close(self):
+        """
+        Stop the scan, discarding the rows not read yet
+        :return: None
+        """
+        self.closed = True
+        for thread in self.threads:
+            while thread.is_alive():
+                for output in self.queues:
+                    while not output.empty():
+                        output.get_nowait()
+                thread.join(0.01)
+        self.iterator.close()
+
+    def put(self, output, data):
+        """
+        Put data in a queue, giving up when the scan is closed
+        :param output: Queue
+        :param data: Chunk of rows, None at the end of the partition or exception
+        :return: True when the data was put
+        """
+        while not self.closed:
+            try:
+                output.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def rows(self):
+        """
+        Rows of the partitions, with the function applied in a process pool keeping at most two chunks by process in flight
+        :return: Generator of rows
+        """
+        try:
+            if self.function is None:
+                for chunk in self.chunks():
+                    yield from chunk
+                return
+            with concurrent.futures.ProcessPoolExecutor(self.processes) as executor:
+                pending = collections.deque()
+                for chunk in self.chunks():
+                    pending.append(executor.submit(ParallelScan.apply, self.function, chunk))
+                    while len(pending) > 2 * self.processes or (len(pending) > 0 and pending[0].done()):
+                        yield from pending.popleft().result()
+                while len(pending) > 0:
+                    yield from pending.popleft().result()
+        finally:
+            self.closed = True
+
+    def run(self, configuration, replica, chunk_size, row_format):
+        """
+        Stream the partitions not started yet in partition order, each one in its own connection and transaction,
+        writing the chunks of rows in the queue of the partition
+        :param configuration: Configuration
+        :param replica: Read from replicas
+        :param chunk_size: Number of rows fetched from the server at once
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :return: None
+        """
+        while not self.closed:
+            try:
+                sql, parameters, output = self.partitions.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with Database(configuration, replica) as database:
+                    cursor = database.stream(sql, parameters, chunk_size, True, True, row_format)
+                    while not self.closed:
+                        data = cursor.fetch_many(chunk_size)
+                        if len(data) == 0:
+                            break
+                        if not self.put(output, data):
+                            break
+                    cursor.close()
+                self.put(output, None)
+            except Exception as exception:
+                self.put(output, exception)
+
+    @staticmethod
+    def workers(configuration, replica, partitions):
+        """
+        Number of partitions streamed concurrently, up to the free connections of the pools read
+        :param configuration: Configuration
+        :param replica: Read from replicas
+        :param partitions: Number of partitions
+        :return: Number of threads
+        """
+        pools = configuration.replicas if replica and len(configuration.replicas) > 0 else [configuration.pool]
+        if any(not pool._maxconnections for pool in pools):
+            return partitions
+        free = min(pool._maxconnections - pool._connections for pool in pools) * len(pools)
+        return max(1, min(partitions, free))
+
+
+class Subscription(object):
+
+    """
+    Subscription to notification channels in a dedicated connection, listening again on the channels when the
+    connection is lost
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def __init__(self, configuration, channels, reconnect_delay=1.0, on_reconnect=None):
+        self.channels = []
+        self.closed = False
+        self.configuration = configuration
+        self.connection = None
+        self.lock = threading.RLock()
+        self.notifications = collections.deque()
+        self.on_reconnect = on_reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnects = 0
+        self.thread = None
+        self.wakeup = os.pipe()
+        self.connect()
+        self.listen(*channels)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        notification = self.get()
+        if notification is None:
+            raise StopIteration()
+        return notification
+
+    def batches(self, window=0.01, max_size=1000):
+        """
+        Generator of the notifications in bursts, each batch waits up to the window after its first notification
+        :param window: Seconds waited for other notifications
+        :param max_size: Maximum number of notifications by batch
+        :return: Generator of lists of notifications, until the subscription is closed
+        """
+        while True:
+            notification = self.get()
+            if notification is None:
+                return
+            batch = [notification]
+            deadline = time.monotonic() + window
+            while len(batch) < max_size:
+                notification = self.get(max(0, deadline - time.monotonic()))
+                if notification is None:
+                    break
+                batch.append(notification)
+            yield batch
+
+    def close(self):
+        """
+        Close the connection, stopping the iteration and the thread of the callback
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        os.write(self.wakeup[1], b'\0')
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+    def connect(self, timeout=None):
+        """
+        Open the connection in autocommit and listen on the channels, the lock is only held to listen
+        :param timeout: Seconds waited for the connection, by default the connect timeout of the configuration
+        :return: True when the connection was opened, False when the subscription was closed or connected meanwhile
+        """
+        data = dict(self.configuration.data)
+        data.pop('maxconnections')
+        if timeout is not None:
+            data['connect_timeout'] = max(1, math.ceil(timeout))
+        connection = psycopg2.connect(**data)
+        connection.autocommit = True
+        with self.lock:
+            if self.closed or self.connection is not None:
+                connection.close()
+                return False
+            try:
+                with connection.cursor() as cursor:
+                    for channel in self.channels:
+                        cursor.execute('listen {}'.format(psycopg2.extensions.quote_ident(channel, connection)))
+            except BaseException:
+                connection.close()
+                raise
+            self.connection = connection
+        return True
+
+    def get(self, timeout=None):
+        """
+        Next notification, waiting for it
+        :param timeout: Seconds waited, by default until a notification arrives or the subscription is closed
+        :return: Notification with channel, payload and pid, None when the timeout expired or the subscription was closed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self.notifications) == 0 and not self.closed:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            self.poll(remaining)
+            if remaining == 0:
+                break
+        return self.notifications.popleft() if len(self.notifications) > 0 else None
+
+    def listen(self, *channels):
+        """
+        Listen on other channels
+        :param channels: Channel names
+        :return: Self
+        """
+        with self.lock:
+            for channel in channels:
+                if channel in self.channels:
+                    continue
+                if self.connection is not None:
+                    with self.connection.cursor() as cursor:
+                        cursor.execute('listen {}'.format(psycopg2.extensions.quote_ident(channel, self.connection)))
+                self.channels.append(channel)
+        return self
+
+    def poll(self, timeout=None):
+        """
+        Wait for notifications, opening the connection again when it was lost; the lock is released while waiting and
+        reconnecting so that other threads can listen and unlisten meanwhile
+        :param timeout: Seconds waited, by default until a notification arrives or the subscription is closed
+        :return: None
+        """
+        with self.lock:
+            if self.closed:
+                return
+            connection = self.connection
+        if connection is None:
+            self.reconnect(timeout)
+            return
+        try:
+            readable, _, _ = select.select([connection, self.wakeup[0]], [], [], timeout)
+        except (OSError, ValueError, psycopg2.InterfaceError):
+            readable = [connection]
+        with self.lock:
+            if self.closed or connection is not self.connection or connection not in readable:
+                return
+            try:
+                connection.poll()
+                while len(connection.notifies) > 0:
+                    self.notifications.append(connection.notifies.pop(0))
+            except (psycopg2.InterfaceError, psycopg2.OperationalError) as exception:
+                logger.warning('Subscription connection was lost: %s', exception)
+                connection.close()
+                self.connection = None
+
+    def reconnect(self, timeout=None):
+        """
+        Open the connection again in one attempt after the reconnect delay, skipped when the timeout expires first
+        :param timeout: Seconds waited, by default the reconnect delay and the connect timeout of the configuration
+        :return: None
+        """
+        if timeout is not None and timeout < self.reconnect_delay:
+            select.select([self.wakeup[0]], [], [], timeout)
+            return
+        select.select([self.wakeup[0]], [], [], self.reconnect_delay)
+        if self.closed:
+            return
+        try:
+            if not self.connect(None if timeout is None else timeout - self.reconnect_delay):
+                return
+        except psycopg2.OperationalError as exception:
+            logger.warning('Subscription connection could not be opened: %s', exception)
+            return
+        self.reconnects += 1
+        if self.on_reconnect is not None:
+            self.on_reconnect(self)
+
+    def start(self, callback, window=None, max_size=1000):
+        """
+        Deliver the notifications to a callback in a background thread, until the subscription is closed
+        :param callback: Function called with each notification, or with each batch when a window is given
+        :param window: Seconds waited for other notifications of a batch, by default the notifications are not batched
+        :param max_size: Maximum number of notifications by batch
+        :return: Self
+        """
+        def run():
+            for item in (self if window is None else self.batches(window, max_size)):
+                try:
+                    callback(item)
+                except Exception:
+                    logger.exception('Subscription callback failed')
+
+        self.thread = threading.Thread(target=run, name='py_postgresql_wrapper_subscription', daemon=True)
+        self.thread.start()
+        return self
+
+    def unlisten(self, *channels):
+        """
+        Stop listening on channels
+        :param channels: Channel names
+        :return: Self
+        """
+        with self.lock:
+            for channel in channels:
+                if channel not in self.channels:
+                    continue
+                if self.connection is not None:
+                    with self.connection.cursor() as cursor:
+                        cursor.execute('unlisten {}'.format(psycopg2.extensions.quote_ident(channel, self.connection)))
+                self.channels.remove(channel)
+        return self
+
+
+class Watchdog(object):
+
+    """
+    Background thread cancelling the statements still running at their deadline
+    """
+
+    __instance__ = None
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.deadlines = []
+        self.thread = None
+        self.watched = {}
+
+    @staticmethod
+    def instance():
+        """
+        Get singleton instance of watchdog
+        :return: Watchdog instance
+        """
+        if Watchdog.__instance__ is None:
+            Watchdog.__instance__ = Watchdog()
+        return Watchdog.__instance__
+
+    def run(self):
+        """
+        Cancel the statements of the connections reaching their deadline
+        :return: None
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while len(self.deadlines) > 0 and (self.deadlines[0][1] not in self.watched or self.deadlines[0][0] <= now):
+                    _, token = heapq.heappop(self.deadlines)
+                    connection = self.watched.pop(token, None)
+                    if connection is not None:
+                        try:
+                            connection.cancel()
+                        except Exception:
+                            pass
+                self.condition.wait(self.deadlines[0][0] - now if len(self.deadlines) > 0 else None)
+
+    def unwatch(self, token):
+        """
+        Stop watching a statement that finished
+        :param token: Token returned by watch
+        :return: None
+        """
+        with self.condition:
+            self.watched.pop(token, None)
+
+    def watch(self, connection, deadline):
+        """
+        Watch a statement, cancelled when it is still running at the deadline
+        :param connection: Connection running the statement
+        :param deadline: Monotonic time of the deadline
+        :return: Token
+        """
+        with self.condition:
+            token = next(self.counter)
+            heapq.heappush(self.deadlines, (deadline, token))
+            self.watched[token] = connection
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return token
+
+
+# Exceptions
+class QueryTimeoutException(psycopg2.errors.QueryCanceled):
+
+    """
+    Query did not finish in its time limit and was cancelled
+    """
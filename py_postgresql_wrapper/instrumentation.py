@@ -0,0 +1,309 @@
+import bisect
+import functools
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+
+EXPLAINABLE_PATTERN = re.compile(r'^\s*(select|insert|update|delete|values|with)\b', re.IGNORECASE)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+MAX_KEYS = 1000
+NUMBER_PATTERN = re.compile(r'\b\d+(\.\d+)?\b')
+OTHER_KEY = 'other'
+STRING_PATTERN = re.compile(r"'(?:[^']|'')*'")
+
+logger = logging.getLogger('py_postgresql_wrapper')
+
+
+class Histogram(object):
+
+    """
+    Histogram of durations in seconds
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.count = 0
+        self.counts = [0] * len(buckets)
+        self.max = 0.0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Record a value
+        :param value: Value
+        :return: None
+        """
+        self.count += 1
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.max = max(self.max, value)
+        self.sum += value
+
+    def quantile(self, quantile):
+        """
+        Estimate a quantile by the upper bound of its bucket
+        :param quantile: Quantile between 0 and 1
+        :return: Value, None when there are no values
+        """
+        if self.count == 0:
+            return None
+        rank = quantile * self.count
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bucket, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Snapshot of the histogram, with cumulative bucket counts
+        :return: Dict
+        """
+        buckets = {}
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            buckets[bucket] = total
+        return {
+            'buckets': buckets,
+            'count': self.count,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'sum': self.sum
+        }
+
+
+class Instrumentation(object):
+
+    """
+    Statistics of queries and pool checkouts, with callbacks called on each event
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.callbacks = []
+        self.checkouts = Histogram(buckets)
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.queries = {}
+
+    def checkout(self, duration, error=None):
+        """
+        Record a pool checkout
+        :param duration: Time waited for the connection in seconds
+        :param error: Exception raised by the checkout
+        :return: None
+        """
+        with self.lock:
+            self.checkouts.observe(duration)
+            if error is not None:
+                self.errors += 1
+        self.notify({'type': 'checkout', 'duration': duration, 'error': error})
+
+    def notify(self, event):
+        """
+        Call the callbacks with an event, a failing callback is logged without failing the query
+        :param event: Event dict
+        :return: None
+        """
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception('Instrumentation callback failed')
+
+    def query(self, key, duration, rows=None, error=None, sql=None, parameters=None):
+        """
+        Record a query execution
+        :param key: Name of the query file or SQL shape
+        :param duration: Execution time in seconds
+        :param rows: Rows returned or affected
+        :param error: Exception raised by the execution
+        :param sql: SQL string executed
+        :param parameters: SQL parameters
+        :return: None
+        """
+        with self.lock:
+            if key not in self.queries and len(self.queries) >= MAX_KEYS:
+                key = OTHER_KEY
+            statistics = self.queries.get(key)
+            if statistics is None:
+                statistics = self.queries[key] = {'errors': 0, 'latency': Histogram(self.buckets), 'rows': 0}
+            statistics['latency'].observe(duration)
+            if error is not None:
+                statistics['errors'] += 1
+                self.errors += 1
+            elif rows is not None and rows > 0:
+                statistics['rows'] += rows
+        self.notify({
+            'type': 'query',
+            'key': key,
+            'duration': duration,
+            'rows': rows,
+            'error': error,
+            'sql': sql,
+            'parameters': parameters
+        })
+
+    def reset(self):
+        """
+        Reset the statistics
+        :return: None
+        """
+        with self.lock:
+            self.checkouts = Histogram(self.buckets)
+            self.errors = 0
+            self.queries = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def shape(sql):
+        """
+        Shape of a SQL string, with normalized white spaces
+        :param sql: SQL string
+        :return: SQL shape
+        """
+        return ' '.join(sql.split())
+
+    def snapshot(self, pools=None):
+        """
+        Snapshot of the statistics
+        :param pools: Gauges of the pools
+        :return: Dict
+        """
+        with self.lock:
+            return {
+                'checkouts': self.checkouts.snapshot(),
+                'errors': self.errors,
+                'pools': pools or {},
+                'queries': {
+                    key: {
+                        'errors': statistics['errors'],
+                        'latency': statistics['latency'].snapshot(),
+                        'rows': statistics['rows']
+                    }
+                    for key, statistics in self.queries.items()
+                }
+            }
+
+    def subscribe(self, callback):
+        """
+        Add a callback called with each checkout and query event
+        :param callback: Function receiving an event dict
+        :return: None
+        """
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Remove a callback
+        :param callback: Function receiving an event dict
+        :return: None
+        """
+        self.callbacks.remove(callback)
+
+
+class SlowQueryLog(object):
+
+    """
+    Callback logging the queries slower than a threshold, optionally with the plan explained in a side connection
+    """
+
+    def __init__(self, configuration, threshold, explain=False, sample_rate=1.0, redact=True, explain_interval=3600):
+        self.configuration = configuration
+        self.explain_interval = explain_interval
+        self.explain_plans = explain
+        self.explained = {}
+        self.lock = threading.Lock()
+        self.redact = redact
+        self.sample_rate = sample_rate
+        self.seen = set()
+        self.thread = None
+        self.threshold = threshold
+
+    def __call__(self, event):
+        if event['type'] != 'query' or event['duration'] * 1000 < self.threshold:
+            return
+        fingerprint = SlowQueryLog.fingerprint(event['key'])
+        with self.lock:
+            first = fingerprint not in self.seen
+            if first and len(self.seen) >= MAX_KEYS:
+                self.seen.clear()
+            self.seen.add(fingerprint)
+            explain = (
+                self.explain_plans and
+                event['error'] is None and
+                event['sql'] is not None and
+                EXPLAINABLE_PATTERN.match(event['sql']) is not None and
+                time.monotonic() - self.explained.get(fingerprint, float('-inf')) >= self.explain_interval
+            )
+            if explain:
+                self.explained[fingerprint] = time.monotonic()
+        if first or random.random() < self.sample_rate:
+            logger.warning(
+                'Slow query %s (%.1f ms): %s - Parameters: %s',
+                fingerprint,
+                event['duration'] * 1000,
+                event['key'],
+                self.redacted(event['parameters'])
+            )
+        if explain:
+            self.thread = threading.Thread(target=self.explain, args=(fingerprint, event['sql'], event['parameters']), daemon=True)
+            self.thread.start()
+
+    def explain(self, fingerprint, sql, parameters):
+        """
+        Log the plan of a query in a side connection rolled back, analyzed only when the query only reads data, as
+        executing a write again would advance sequences, fire triggers and wait on the row locks of its transaction
+        :param fingerprint: Statement fingerprint
+        :param sql: SQL string
+        :param parameters: SQL parameters
+        :return: None
+        """
+        from .database import Database
+        try:
+            connection = self.configuration.pool.connection()
+        except Exception as exception:
+            logger.warning('Slow query %s could not be explained: %s', fingerprint, exception)
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute("set local lock_timeout = '1s'")
+            cursor.execute('{} {}'.format('explain (analyze, buffers)' if Database.read_only(sql) else 'explain', sql), parameters)
+            logger.warning('Slow query %s plan:\n%s', fingerprint, '\n'.join(row[0] for row in cursor.fetchall()))
+            cursor.close()
+        except Exception as exception:
+            logger.warning('Slow query %s could not be explained: %s', fingerprint, exception)
+        finally:
+            connection.rollback()
+            connection.close()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def fingerprint(key):
+        """
+        Fingerprint of a statement, without its literals
+        :param key: Name of the query file or SQL shape
+        :return: Fingerprint
+        """
+        shape = NUMBER_PATTERN.sub('?', STRING_PATTERN.sub('?', key.lower()))
+        return hashlib.sha1(shape.encode('utf-8')).hexdigest()[:16]
+
+    def redacted(self, parameters):
+        """
+        Parameters with the redacted values replaced
+        :param parameters: SQL parameters
+        :return: Redacted parameters
+        """
+        if parameters is None or self.redact is False:
+            return parameters
+        if isinstance(parameters, dict):
+            return {
+                key: '<redacted>' if self.redact is True or key in self.redact else value
+                for key, value in parameters.items()
+            }
+        return ['<redacted>' for _ in parameters] if self.redact is True else parameters
@@ -0,0 +1,380 @@
+from .cache import CachedCursor
+from .configuration import Configuration
+from .database import BatchResult, CursorWrapper, Database, DeleteBuilder, InsertBuilder, Keyset, Page, SelectBuilder, UpdateBuilder
+
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import heapq
+import itertools
+
+
+class ShardedDatabase(object):
+
+    """
+    Facade to access the shards of a database, routing the statements by the value of the shard key and executing
+    the others in all the shards in parallel
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        error = None
+        for database in self.databases:
+            try:
+                if error is None:
+                    database.__exit__(exception_type, exception_value, exception_traceback)
+                else:
+                    database.__exit__(type(error), error, error.__traceback__)
+            except BaseException as exception:
+                if error is None:
+                    error = exception
+        if error is not None:
+            raise error
+
+    def __init__(self, configuration=None, replica=True, timeout=None):
+        self.configuration = Configuration.instance() if configuration is None else configuration
+        if len(self.configuration.shards) == 0:
+            raise ValueError('Configuration has no shards')
+        self.databases = [Database(shard, replica, timeout=timeout) for shard in self.configuration.shards]
+        self.shard_key = self.configuration.shard_key
+
+    def delete(self, table):
+        """
+        Delete string command
+        :param table: Table name
+        :return: Delete builder
+        """
+        return ShardedDeleteBuilder(self, table)
+
+    def execute(self, sql, parameters=None, skip_load_query=False, replica=None, cache=None, tags=None, row_format='wrapper', timeout=None, prepare=False):
+        """
+        Execute query by name in the shard of the parameter named as the shard key, a select without it is executed
+        in all the shards
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param skip_load_query: Skip load file
+        :param replica: Execute in a replica, by default only the read-only query files
+        :param cache: Cache the rows, True for the default TTL or the TTL in seconds
+        :param tags: Tables read by the query, its cached rows are invalidated when they are written
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :param timeout: Time limit in seconds, bounded by the timeout of the database
+        :param prepare: Execute with a prepared statement when they are enabled, always for the query files
+        :return: Cursor
+        """
+        database = self.route(parameters)
+        if database is not None:
+            return database.execute(sql, parameters, skip_load_query, replica, cache, tags, row_format, timeout, prepare)
+        if not Database.read_only(sql if skip_load_query else Database.load_query(sql)):
+            raise ValueError('Statement without the shard key {} must be executed with scatter'.format(self.shard_key))
+        return self.scatter(sql, parameters, skip_load_query, replica, row_format, timeout=timeout)
+
+    def insert(self, table):
+        """
+        Insert string command
+        :param table: Table name
+        :return: Insert builder
+        """
+        return ShardedInsertBuilder(self, table)
+
+    @staticmethod
+    def merge(cursors, order_by=None, row_format='wrapper'):
+        """
+        Merge the cursors of the shards, keeping the order of the order by fields
+        :param cursors: Cursor of each shard
+        :param order_by: Order by fields of the rows of each cursor
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :return: Cursor over the rows
+        """
+        description = next((cursor.cursor.description for cursor in cursors if cursor.cursor.description is not None), None)
+        rows = [cursor.cursor.fetchall() if cursor.cursor.description is not None else [] for cursor in cursors]
+        if order_by:
+            rows = list(heapq.merge(*rows, key=ShardedDatabase.sort_key(order_by, description)))
+        else:
+            rows = list(itertools.chain.from_iterable(rows))
+        merged = CachedCursor(rows, description)
+        merged.rowcount = sum(cursor.row_count() for cursor in cursors)
+        return CursorWrapper(merged, row_format=row_format)
+
+    @staticmethod
+    def merge_pages(pages, page, size, order_by=None, keyset=False):
+        """
+        Merge the pages of the shards, each one holding the rows of the shard up to the end of the page
+        :param pages: Page of each shard
+        :param page: Page number
+        :param size: Page size
+        :param order_by: Order by fields of the rows of each page
+        :param keyset: Keyset pagination, the pages start after the cursor
+        :return: Page
+        """
+        if order_by:
+            data = list(heapq.merge(*[shard.data for shard in pages], key=ShardedDatabase.sort_key(order_by)))
+        else:
+            data = list(itertools.chain.from_iterable(shard.data for shard in pages))
+        start = 0 if keyset else page * size
+        rows = data[start:start + size]
+        last = all(shard.last for shard in pages) and len(data) <= start + size
+        totals = [shard.total for shard in pages]
+        total = None if None in totals else sum(totals)
+        return Page(page, size, rows, last, Keyset(order_by).encode(rows[-1]) if keyset and not last else None, total)
+
+    def paging(self, sql, page=0, parameters=None, size=10, skip_load_query=True, order_by=None, cursor=None, count=None, timeout=None):
+        """
+        Paging string command, in the shard of the parameter named as the shard key or else in all the shards, each
+        one limited to the end of the page and merged by the order by fields
+        :param sql: String or name of file
+        :param page: Page number
+        :param parameters: SQL parameters
+        :param size: Page size
+        :param skip_load_query: Skip load file
+        :param order_by: Order by result fields, for keyset pagination
+        :param cursor: Cursor of the previous page, for keyset pagination
+        :param count: Total count strategy, exact, window or estimate, summed over the shards
+        :param timeout: Time limit in seconds for the page and its count
+        :return: Page
+        """
+        database = self.route(parameters)
+        if database is not None:
+            return database.paging(sql, page, parameters, size, skip_load_query, order_by, cursor, count, timeout)
+        if order_by is not None:
+            pages = self.parallel(lambda shard: shard.paging(sql, 0, parameters, size, skip_load_query, order_by, cursor, count, timeout))
+        else:
+            pages = self.parallel(lambda shard: shard.paging(sql, 0, parameters, (page + 1) * size, skip_load_query, None, None, count, timeout))
+        return ShardedDatabase.merge_pages(pages, page, size, order_by, order_by is not None)
+
+    def parallel(self, function):
+        """
+        Call a function with the database of each shard concurrently, in one thread by shard
+        :param function: Function of a database
+        :return: Return of the function for each shard in order
+        """
+        if len(self.databases) == 1:
+            return [function(self.databases[0])]
+        with concurrent.futures.ThreadPoolExecutor(len(self.databases)) as executor:
+            return list(executor.map(function, self.databases))
+
+    def route(self, parameters):
+        """
+        Database of the shard of the parameter named as the shard key
+        :param parameters: SQL parameters
+        :return: Database, None when the parameters do not have the shard key
+        """
+        if not isinstance(parameters, dict) or parameters.get(self.shard_key) is None:
+            return None
+        return self.shard(parameters[self.shard_key])
+
+    def scatter(self, sql, parameters=None, skip_load_query=False, replica=None, row_format='wrapper', order_by=None, timeout=None):
+        """
+        Execute query by name in all the shards in parallel, merging the rows
+        :param sql: String or name of file
+        :param parameters: SQL parameters
+        :param skip_load_query: Skip load file
+        :param replica: Execute in a replica, by default only the read-only query files
+        :param row_format: Format of the rows, wrapper, dict, record or tuple
+        :param order_by: Order by fields of the query, the rows of the shards are merged in this order
+        :param timeout: Time limit in seconds, bounded by the timeout of the database
+        :return: Cursor over the rows of all the shards, with the sum of their row counts
+        """
+        cursors = self.parallel(lambda shard: shard.execute(sql, parameters, skip_load_query, replica, row_format=row_format, timeout=timeout))
+        return ShardedDatabase.merge(cursors, order_by, row_format)
+
+    def select(self, table):
+        """
+        Select string command
+        :param table: Table name
+        :return: Select builder
+        """
+        return ShardedSelectBuilder(self, table)
+
+    def shard(self, value):
+        """
+        Database of the shard of a shard key value
+        :param value: Shard key value
+        :return: Database
+        """
+        return self.databases[self.shard_index(value)]
+
+    def shard_index(self, value):
+        """
+        Index of the shard of a shard key value, by a hash stable across processes modulo the number of shards
+        :param value: Shard key value
+        :return: Shard index
+        """
+        digest = hashlib.md5(str(value).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % len(self.databases)
+
+    @staticmethod
+    def sort_key(order_by, description=None):
+        """
+        Sort key of rows by order by fields, with the nulls last in ascending order as in the server
+        :param order_by: Order by fields
+        :param description: Description of the result columns, for rows without names
+        :return: Sort key
+        """
+        columns = [column[0] for column in description] if description is not None else None
+        fields = []
+        for field in order_by:
+            parts = field.split()
+            if len(parts) not in (1, 2) or (len(parts) == 2 and parts[1].lower() not in ('asc', 'desc')):
+                raise ValueError('{} is not a valid order by field to merge'.format(field))
+            name = parts[0].split('.')[-1]
+            if columns is not None and name not in columns:
+                raise ValueError('Order by field {} is not in the result'.format(name))
+            fields.append((name, columns.index(name) if columns is not None else None, len(parts) == 2 and parts[1].lower() == 'desc'))
+
+        def compare(left, right):
+            for name, index, descending in fields:
+                left_value = left[name] if isinstance(left, dict) else left[index]
+                right_value = right[name] if isinstance(right, dict) else right[index]
+                if left_value == right_value:
+                    continue
+                if left_value is None:
+                    result = 1
+                elif right_value is None:
+                    result = -1
+                else:
+                    result = -1 if left_value < right_value else 1
+                return -result if descending else result
+            return 0
+
+        return functools.cmp_to_key(compare)
+
+    def update(self, table):
+        """
+        Update string command
+        :param table: Table name
+        :return: Update builder
+        """
+        return ShardedUpdateBuilder(self, table)
+
+
+# Builders
+class ShardedBuilder(object):
+
+    """
+    Builder of a sharded database, executed in the shard of the shard key value of its where conditions or of its rows
+    """
+
+    def bind(self, database):
+        """
+        Copy of the builder in the database of a shard
+        :param database: Database
+        :return: Builder
+        """
+        builder = copy.copy(self)
+        builder.database = database
+        builder.parameters = dict(self.parameters)
+        builder.where_conditions = list(self.where_conditions)
+        return builder
+
+    def execute(self):
+        """
+        Execute SQL in the shard of the shard key value, the rows are grouped by shard and executed in batches in each one
+        :return: Cursor or batch result
+        """
+        if self.bulk_rows is None:
+            return super(ShardedBuilder, self.bind(self.database.shard(self.shard_value()))).execute()
+        shards = {}
+        for row in self.bulk_rows:
+            shards.setdefault(self.database.shard_index(self.shard_value(row)), []).append(row)
+        counts = []
+        data = []
+        for index in sorted(shards.keys()):
+            builder = self.bind(self.database.databases[index])
+            builder.bulk_rows = shards[index]
+            result = super(ShardedBuilder, builder).execute()
+            counts.extend(result.counts)
+            data.extend(result.data)
+        return BatchResult(counts, data)
+
+    def shard_value(self, row=None):
+        """
+        Shard key value of the builder, from a row or from an equality where condition
+        :param row: Row dict
+        :return: Shard key value
+        """
+        value = self.where_value()
+        if row is not None and self.database.shard_key in row:
+            value = row[self.database.shard_key]
+        if value is None:
+            raise ValueError('{} without the shard key {} can not be routed to a shard'.format(self.table, self.database.shard_key))
+        return value
+
+    def where_value(self):
+        """
+        Shard key value of an equality where condition
+        :return: Shard key value, None when there is no such condition
+        """
+        for field, operator, value, constant in self.where_clauses:
+            if field.split('.')[-1] == self.database.shard_key and operator == '=' and not constant:
+                return value
+        return None
+
+
+class ShardedDeleteBuilder(ShardedBuilder, DeleteBuilder):
+
+    """
+    Delete builder of a sharded database
+    """
+
+
+class ShardedInsertBuilder(ShardedBuilder, InsertBuilder):
+
+    """
+    Insert builder of a sharded database, routed by the shard key value set
+    """
+
+    def where_value(self):
+        """
+        Shard key value set
+        :return: Shard key value, None when it was not set
+        """
+        return self.parameters.get(self.database.shard_key)
+
+
+class ShardedSelectBuilder(ShardedBuilder, SelectBuilder):
+
+    """
+    Select builder of a sharded database, executed in all the shards in parallel without a shard key value
+    """
+
+    def execute(self):
+        """
+        Execute SQL in the shard of the shard key value, or else in all the shards merging the rows by the order by
+        fields
+        :return: Cursor
+        """
+        if self.where_value() is not None:
+            return super(ShardedSelectBuilder, self).execute()
+        cursors = self.database.parallel(lambda database: SelectBuilder.execute(self.bind(database)))
+        return ShardedDatabase.merge(cursors, self.select_order_by, self.select_row_format)
+
+    def paging(self, page=0, size=10, cursor=None, keyset=False, count=None, timeout=None):
+        """
+        Pagination in the shard of the shard key value, or else in all the shards, each one limited to the end of the
+        page and merged by the order by fields
+        :param page: Page number
+        :param size: Page size
+        :param cursor: Cursor of the previous page, for keyset pagination
+        :param keyset: Keyset pagination
+        :param count: Total count strategy, exact, window or estimate, summed over the shards
+        :param timeout: Time limit in seconds for the page and its count, by default the timeout of the builder
+        :return: Page
+        """
+        if self.where_value() is not None:
+            return SelectBuilder.paging(self.bind(self.database.shard(self.where_value())), page, size, cursor, keyset, count, timeout)
+        keyset = keyset or cursor is not None
+        if keyset:
+            pages = self.database.parallel(lambda database: SelectBuilder.paging(self.bind(database), 0, size, cursor, True, count, timeout))
+        else:
+            pages = self.database.parallel(lambda database: SelectBuilder.paging(self.bind(database), 0, (page + 1) * size, None, False, count, timeout))
+        return ShardedDatabase.merge_pages(pages, page, size, self.select_order_by, keyset)
+
+
+class ShardedUpdateBuilder(ShardedBuilder, UpdateBuilder):
+
+    """
+    Update builder of a sharded database
+    """
@@ -15,6 +15,9 @@ setup(
         'Topic :: Database'
     ],
     description='PyPostgreSQLWrapper is a simple adapter for PostgreSQL with connection pooling',
+    extras_require={
+        'numpy': ['numpy']
+    },
     install_requires=[
         'dbutils',
         'psycopg2-binary'
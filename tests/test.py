@@ -1,9 +1,98 @@
-from py_postgresql_wrapper.configuration import Configuration
-from py_postgresql_wrapper.database import Database, Page
+from py_postgresql_wrapper.async_database import AsyncDatabase
+from py_postgresql_wrapper.configuration import Configuration, PoolTimeoutException
+from py_postgresql_wrapper.database import Database, Page, QueryRegistry, QueryTimeoutException
+from py_postgresql_wrapper.sharded_database import ShardedDatabase
+
+import asyncio
+import io
+import json
+import logging
+import os
+import pytest
+import struct
+import tempfile
+import time
 
 Configuration.instance(configuration_file='configuration.json')
 
 
+def test_async_database():
+    async def crud():
+        async with AsyncDatabase() as database:
+            await database.execute('drop table if exists test_async')
+            await database.execute('create table test_async (id int primary key, description varchar(255))')
+            await database.insert('test_async').rows({'id': index, 'description': 'Test {}'.format(index)} for index in range(20)).execute()
+            assert (await database.update('test_async').set('description', 'New Test 1').where('id', 1).execute()).row_count() == 1
+            data = await database.select('test_async').where('id', 1).execute()
+            assert [row.description async for row in data] == ['New Test 1']
+            data = await database.select('test_async').order_by('id').paging(1, 5, count='exact')
+            assert [row.id for row in data.data] == [5, 6, 7, 8, 9]
+            assert data.total == 20
+            assert [row.id async for row in database.select('test_async').where('id', 3, operator='<').order_by('id').stream(chunk_size=2)] == [0, 1, 2]
+            with pytest.raises(NotImplementedError):
+                database.select('test_async').scan()
+            with pytest.raises(NotImplementedError):
+                database.select('test_async').copy_out()
+
+    async def sleep():
+        async with AsyncDatabase() as database:
+            return (await database.execute('select pg_sleep(0.2) is null as slept')).fetch_one().slept
+
+    async def test():
+        await crud()
+        assert await asyncio.gather(*[sleep() for _ in range(20)]) == [False] * 20
+        try:
+            async with AsyncDatabase() as database:
+                await database.delete('test_async').execute()
+                raise ValueError()
+        except ValueError:
+            pass
+        async with AsyncDatabase() as database:
+            assert (await database.select('test_async').execute()).row_count() == 20
+
+    asyncio.run(test())
+
+
+def test_copy_in():
+    with Database() as database:
+        database.execute('drop table if exists test_copy')
+        database.execute('create table test_copy (id int primary key, description text, data bytea)')
+        rows = ({'id': index, 'description': 'Test\t{}\\'.format(index), 'data': None if index % 2 else b'\x00'} for index in range(1000))
+        assert database.copy_in('test_copy', rows, buffer_size=128).row_count() == 1000
+        data = database.select('test_copy').where('id', 2).execute().fetch_one()
+        assert data.description == 'Test\t2\\'
+        assert bytes(data.data) == b'\x00'
+        database.copy_in('test_copy', [(struct.pack('!i', 1000), b'Test', None)], format='binary')
+        assert database.select('test_copy').where('id', 1000).execute().fetch_one().description == 'Test'
+        database.execute('drop table if exists test_copy_types')
+        database.execute('create table test_copy_types (id int primary key, matrix int[][], data jsonb)')
+        database.copy_in('test_copy_types', [{'id': 1, 'matrix': [[1, 2], [3, None]], 'data': {'a': 'Test\t1'}}])
+        data = database.select('test_copy_types').where('id', 1).execute().fetch_one()
+        assert (data.matrix, data.data) == ([[1, 2], [3, None]], {'a': 'Test\t1'})
+
+
+def test_copy_out():
+    with Database() as database:
+        database.execute('drop table if exists test_copy_out')
+        database.execute('create table test_copy_out (id int primary key, description text)')
+        database.insert('test_copy_out').rows({'id': index, 'description': 'Test {}'.format(index)} for index in range(1000)).execute()
+        sink = io.BytesIO()
+        database.select('test_copy_out').where('id', 3, operator='<').order_by('id').copy_out(sink)
+        assert sink.getvalue() == b'id,description\n0,Test 0\n1,Test 1\n2,Test 2\n'
+        data = b''.join(database.copy_out('select * from test_copy_out', format='text', buffer_size=128))
+        assert data.count(b'\n') == 1000
+        stream = database.copy_out('select * from test_copy_out')
+        next(stream)
+        stream.close()
+        assert database.select('test_copy_out').execute().row_count() == 1000
+        stream = database.copy_out('select * from test_copy_out', buffer_size=128)
+        next(stream)
+        assert database.select('test_copy_out').execute().row_count() == 1000
+        assert stream.closed and not stream.thread.is_alive()
+        stream = database.copy_out('select * from test_copy_out', buffer_size=128)
+    assert stream.closed and not stream.thread.is_alive()
+
+
 def test_create_table():
     with Database() as database:
         database.execute('''
@@ -17,6 +106,44 @@ def test_create_table():
         ''')
 
 
+def test_deferred():
+    configuration = Configuration(configuration_file='configuration.json')
+    events = []
+    configuration.instrumentation.subscribe(events.append)
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_deferred')
+        database.execute('create table test_deferred (id int primary key, description varchar(255))')
+    del events[:]
+    with Database(configuration, deferred=True) as database:
+        first = database.insert('test_deferred').set('id', 1).set('description', '100%').execute()
+        second = database.insert('test_deferred').set('id', 2).set('description', 'Test 2').execute()
+        third = database.update('test_deferred').set('description', 'New Test 2').where('id', 2).execute()
+        fourth = database.delete('test_deferred').where('id', 3).execute()
+        assert len(events) == 0
+        assert [result.row_count() for result in (first, second, third, fourth)] == [1, 1, 1, 0]
+        assert len([event for event in events if event['type'] == 'query']) == 1
+        database.insert('test_deferred').set('id', 3).set('description', 'Test 3').execute()
+        assert database.select('test_deferred').where('id', 3).execute().fetch_one().description == 'Test 3'
+        assert database.insert('test_deferred').set('id', 4).set('description', 'Test 4').returning('id').execute().fetch_one().id == 4
+        database.delete('test_deferred').where('id', 4).execute()
+    with Database(configuration) as database:
+        data = database.select('test_deferred').order_by('id').execute().fetch_all()
+        assert [(row.id, row.description) for row in data] == [(1, '100%'), (2, 'New Test 2'), (3, 'Test 3')]
+    with pytest.raises(Exception):
+        with Database(configuration, deferred=True) as database:
+            first = database.update('test_deferred').set('description', 'Updated').where('id', 1).execute()
+            second = database.insert('test_deferred').set('id', 1).set('description', 'Duplicated').execute()
+            third = database.insert('test_deferred').set('id', 5).set('description', 'Test 5').execute()
+    assert first.row_count() == 1
+    with pytest.raises(Exception) as exception:
+        second.row_count()
+    assert exception.value.pgcode == '23505'
+    with pytest.raises(RuntimeError):
+        third.row_count()
+    with Database(configuration) as database:
+        assert database.select('test_deferred').where('id', 1).execute().fetch_one().description == '100%'
+
+
 def test_delete_by_id():
     with Database() as database:
         database.delete('test').where('id', 1).execute()
@@ -29,6 +156,25 @@ def test_delete_with_like():
         assert len(database.execute("select id, description from test").fetch_all()) == 0
 
 
+def test_fetch_columns():
+    numpy = pytest.importorskip('numpy')
+    with Database() as database:
+        sql = '''
+            select id, id * 1.5::float8 as value, nullif(id % 3, 0) as remainder, 'Test ' || id as description
+            from generate_series(1, 2500) as id
+            order by id
+        '''
+        data = database.execute(sql, row_format='tuple').fetch_columns()
+        assert data['id'].dtype == numpy.int32
+        assert data['value'].sum() == 1.5 * 3126250
+        assert numpy.ma.count_masked(data['remainder']) == 833
+        assert data['description'][0] == 'Test 1'
+        cursor = database.execute(sql)
+        data = cursor.fetch_many_columns(10)
+        assert list(data['id']) == list(range(1, 11))
+        assert len(cursor.fetch_many_columns(5000)['id']) == 2490
+
+
 def test_find_all():
     with Database() as database:
         data = database.execute('select id, description from test').fetch_all()
@@ -69,6 +215,24 @@ def test_find_many():
         assert len(data) == 2
 
 
+def test_find_paging_by_count():
+    with Database() as database:
+        database.execute('drop table if exists test_count')
+        database.execute('create table test_count (id int primary key)')
+        database.insert('test_count').rows({'id': index} for index in range(250)).execute()
+        data = database.select('test_count').order_by('id').paging(1, 20, count='exact')
+        assert data.total == 250
+        assert data.total_pages == 13
+        assert data.data[0] == {'id': 20}
+        assert database.select('test_count').order_by('id').paging(20, 20, count='exact').total == 250
+        assert database.select('test_count').order_by('id').paging(0, 20, count='window').total == 201
+        assert database.select('test_count').order_by('id').paging(0, 20, keyset=True, count='exact').total == 250
+        assert database.select('test_count').paging(0, 20, count='estimate').total > 0
+        assert database.paging('select id from test_count order by id', 2, size=100, count='exact').total == 250
+        assert database.paging('select id from test_count where id < 100', 0, size=10, count='estimate').total > 0
+        assert database.select('test_count').paging(0, 20).total is None
+
+
 def test_find_paging_by_select():
     with Database() as database:
         data = database.select('test').fields('id', 'description').where('id', 3, operator='<').order_by('id').paging(0, 2)
@@ -85,12 +249,68 @@ def test_find_paging_by_select_without_where():
         assert len(data.data) == 2
 
 
+def test_find_paging_by_keyset():
+    with Database() as database:
+        database.execute('drop table if exists test_keyset')
+        database.execute('create table test_keyset (id int primary key, grp int)')
+        database.insert('test_keyset').rows({'id': index, 'grp': index % 3} for index in range(10)).execute()
+        data = database.select('test_keyset').order_by('grp', 'id').paging(size=4, keyset=True)
+        assert [row.id for row in data.data] == [0, 3, 6, 9]
+        assert data.last is False
+        data = database.select('test_keyset').order_by('grp', 'id').paging(size=4, cursor=data.cursor)
+        assert [row.id for row in data.data] == [1, 4, 7, 2]
+        data = database.select('test_keyset').order_by('grp', 'id').paging(size=4, cursor=data.cursor)
+        assert [row.id for row in data.data] == [5, 8]
+        assert data.last is True
+        assert data.cursor is None
+        data = database.paging('select * from test_keyset where id > %(id)s', parameters={'id': 1}, size=5, order_by=['id desc'])
+        assert [row.id for row in data.data] == [9, 8, 7, 6, 5]
+        data = database.paging('select * from test_keyset where id > %(id)s', parameters={'id': 1}, size=5, order_by=['id desc'], cursor=data.cursor)
+        assert [row.id for row in data.data] == [4, 3, 2]
+        data = database.paging('select t.* from test_keyset t', size=5, order_by=['t.id'])
+        data = database.paging('select t.* from test_keyset t', size=5, order_by=['t.id'], cursor=data.cursor)
+        assert [row.id for row in data.data] == [5, 6, 7, 8, 9]
+        select = database.select('test_keyset').order_by('grp', 'id')
+        data = select.paging(size=4, keyset=True)
+        select.paging(size=4, cursor=data.cursor)
+        assert select.execute().row_count() == 10
+        assert select.paging(0, 3, count='exact').total == 10
+
+
 def test_find_without_result():
     with Database() as database:
         data = database.select('test').where('1', '0', constant=True).execute().fetch_one()
         assert data is None
 
 
+def test_gather():
+    with Database() as database:
+        start = time.perf_counter()
+        data = database.gather([
+            'select pg_sleep(0.5) is null as slept',
+            ('select %(value)s as value', {'value': 1}),
+            database.select('pg_database').fields('datname').where('datname', 'postgres'),
+            'select * from test_not_found',
+            ('select pg_sleep(0.5) is null as slept', None)
+        ])
+        assert time.perf_counter() - start < 0.9
+        assert data[0] == [{'slept': False}]
+        assert data[1][0].value == 1
+        assert data[2][0].datname == 'postgres'
+        assert isinstance(data[3], Exception)
+        assert data[4] == [{'slept': False}]
+        data = database.gather(['select pg_sleep(5)', 'select 1 as value', 'select pg_sleep(5)'], workers=2, timeout=0.5)
+        assert isinstance(data[0], TimeoutError)
+        assert data[1][0].value == 1
+        assert isinstance(data[2], TimeoutError)
+        assert time.perf_counter() - start < 2
+        start = time.perf_counter()
+        data = database.gather(['select pg_sleep(0.4) is null as slept', 'select pg_sleep(0.4)', 'select 1 as value'], workers=1, timeout=0.5)
+        assert data[0] == [{'slept': False}]
+        assert isinstance(data[1], TimeoutError) and isinstance(data[2], TimeoutError)
+        assert time.perf_counter() - start < 0.7
+
+
 def test_insert():
     with Database() as database:
         database.insert('test').set('id', 1).set('description', 'Test 1').execute()
@@ -99,6 +319,185 @@ def test_insert():
         database.insert('test').set('id', 4).set('description', 'Test 4').execute()
 
 
+def test_insert_rows():
+    with Database() as database:
+        database.execute('drop table if exists test_rows')
+        database.execute('create table test_rows (id int primary key, description varchar(255), created timestamp)')
+        rows = ({'id': index, 'description': 'Test {}'.format(index)} for index in range(5))
+        data = database.insert('test_rows').set('created', 'now()', constant=True).rows(rows, batch_size=2).returning('id').execute()
+        assert data.counts == [2, 2, 1]
+        assert data.row_count() == 5
+        assert [row.id for row in data.data] == [0, 1, 2, 3, 4]
+        assert database.select('test_rows').where('created', 'null', constant=True, operator='is not').execute().row_count() == 5
+
+
+def test_loader():
+    configuration = Configuration(configuration_file='configuration.json')
+    events = []
+    configuration.instrumentation.subscribe(events.append)
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_loader')
+        database.execute('create table test_loader (id int primary key, parent_id int, description varchar(255))')
+        database.insert('test_loader').rows({'id': index, 'parent_id': index % 3, 'description': 'Test {}'.format(index)} for index in range(10)).execute()
+    with Database(configuration) as database:
+        del events[:]
+        results = [database.loader('test_loader').load(index) for index in (1, 2, 2, 20)]
+        assert [result.get() and result.get().description for result in results] == ['Test 1', 'Test 2', 'Test 2', None]
+        assert database.loader('test_loader').load_many([1, 3]) == [results[0].get(), {'id': 3, 'parent_id': 0, 'description': 'Test 3'}]
+        children = database.loader(database.select('test_loader').where('id', 0, operator='>'), key='parent_id', many=True)
+        assert [[row.id for row in rows] for rows in children.load_many([0, 1, 5])] == [[3, 6, 9], [1, 4, 7], []]
+        assert len([event for event in events if event['type'] == 'query']) == 3
+        database.update('test_loader').set('description', 'New Test 1').where('id', 1).execute()
+        assert database.loader('test_loader').load(1).get().description == 'New Test 1'
+
+    async def load():
+        async with AsyncDatabase(configuration) as database:
+            loader = database.loader('test_loader', batch_size=2)
+            other = database.loader('test_loader', key='parent_id', many=True)
+            loader.prime(100, None)
+            data = await asyncio.gather(loader.load(1), loader.load(2), loader.load(3), loader.load(100), other.load(2))
+            assert [row and row.id for row in data[:4]] == [1, 2, 3, None]
+            assert [row.id for row in data[4]] == [2, 5, 8]
+            assert await loader.load_many([3, 4]) == [data[2], {'id': 4, 'parent_id': 1, 'description': 'Test 4'}]
+
+    del events[:]
+    asyncio.run(load())
+    assert len([event for event in events if event['type'] == 'query']) == 4
+
+
+def test_pool():
+    data = json.load(open('configuration.json'))
+    data.update({'pool_idle_timeout': 0.2, 'pool_max_lifetime': 1, 'pool_min_idle': 2, 'pool_ping_after': None})
+    configuration = Configuration(configuration_dict=data)
+    assert configuration.statistics()['pools']['primary']['idle'] == 2
+    with Database(configuration) as first, Database(configuration) as second, Database(configuration) as third:
+        pids = [database.execute('select pg_backend_pid() as pid').fetch_one().pid for database in (first, second, third)]
+    with Database() as database:
+        database.execute('select pg_terminate_backend(pid) from unnest(%(pids)s) as pid', {'pids': pids})
+    assert configuration.statistics()['pools']['primary']['idle'] == 3
+    time.sleep(0.3)
+    with Database(configuration) as first, Database(configuration) as second:
+        for database in (first, second):
+            assert database.execute('select pg_backend_pid() as pid').fetch_one().pid not in pids
+    assert configuration.statistics()['pools']['primary']['idle'] == 2
+    with Database(configuration) as database:
+        pid = database.execute('select pg_backend_pid() as pid').fetch_one().pid
+    time.sleep(1.1)
+    with Database(configuration) as first, Database(configuration) as second:
+        assert pid not in [database.execute('select pg_backend_pid() as pid').fetch_one().pid for database in (first, second)]
+    configuration = Configuration(configuration_file='configuration.json')
+    with Database(configuration) as database:
+        pid = database.execute('select pg_backend_pid() as pid').fetch_one().pid
+    child = os.fork()
+    if child == 0:
+        with Database(configuration) as database:
+            os._exit(0 if database.execute('select pg_backend_pid() as pid').fetch_one().pid != pid else 1)
+    assert os.waitpid(child, 0)[1] == 0
+    with Database(configuration) as database:
+        assert database.execute('select pg_backend_pid() as pid').fetch_one().pid == pid
+
+
+def test_prepared_statements():
+    configuration = Configuration(configuration_file='configuration.json')
+    configuration.prepared_statements = 2
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_prepared')
+        database.execute('create table test_prepared (id int primary key, description varchar(255))')
+        for index in range(3):
+            database.insert('test_prepared').set('id', index).set('description', 'Test {}'.format(index)).execute()
+        for index in range(3):
+            assert database.select('test_prepared').where('id', index).execute().fetch_one().id == index
+        assert database.update('test_prepared').set('description', 'Test%').where('id', 1).execute().row_count() == 1
+        assert database.select('test_prepared').where('description', "'Test%%'", constant=True).execute().row_count() == 1
+        assert database.execute('select count(*) as total from pg_prepared_statements').fetch_one().total == 2
+        database.execute('deallocate all')
+        assert database.select('test_prepared').where('id', 1).execute().fetch_one().description == 'Test%'
+        assert database.select('test_prepared').where('id', (1, 2), operator='in').execute().row_count() == 2
+        assert database.select('test_prepared').where('id', (0, 1), operator='in').execute().row_count() == 2
+        assert database.execute('select id from test_prepared where id in %(ids)s', {'ids': (0, 1)}).row_count() == 2
+        assert database.execute('select %(value)s as value', {'value': 1, 'other': 2}).fetch_one().value == 1
+    with Database(configuration) as database:
+        database.execute('alter table test_prepared add column extra int')
+    with pytest.raises(Exception) as exception:
+        with Database(configuration) as database:
+            database.select('test_prepared').where('id', 1).execute()
+    assert exception.value.pgcode == '0A000'
+    with Database(configuration) as database:
+        assert database.select('test_prepared').where('id', 1).execute().fetch_one().extra is None
+
+
+def test_query_registry():
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, 'test'))
+        with open(os.path.join(directory, 'test', 'find_all.sql'), 'w') as file:
+            file.write('select * from test')
+        registry = QueryRegistry(directory, reload=True)
+        assert registry.get('test/find_all') == 'select * from test'
+        assert registry.get('select * from test where id = 1') == 'select * from test where id = 1'
+        with open(os.path.join(directory, 'test', 'find_all.sql'), 'w') as file:
+            file.write('select id from test')
+        os.utime(os.path.join(directory, 'test', 'find_all.sql'), ns=(0, 0))
+        assert registry.get('test/find_all') == 'select id from test'
+        with open(os.path.join(directory, 'find_one.sql'), 'w') as file:
+            file.write('select * from test limit 1')
+        assert registry.get('find_one') == 'select * from test limit 1'
+        assert QueryRegistry(directory).get('find_one') == 'select * from test limit 1'
+
+
+def test_replicas():
+    data = json.load(open('configuration.json'))
+    data.update({'replicas': [{'database': 'template1', 'max_connection': 2}], 'replica_strategy': 'least_in_use'})
+    configuration = Configuration(configuration_dict=data)
+    with Database(configuration) as database:
+        assert database.select('pg_database').fields('current_database() as name').execute().fetch_one().name == 'template1'
+        assert database.paging('select current_database() as name').data[0].name == 'template1'
+        assert database.execute('select current_database() as name').fetch_one().name == 'postgres'
+        assert database.primary_connection is not None
+        database.execute('create temporary table test_replicas (id int)')
+        assert database.select('pg_database').fields('current_database() as name').execute().fetch_one().name == 'postgres'
+    with Database(configuration, replica=False) as database:
+        assert database.select('pg_database').fields('current_database() as name').execute().fetch_one().name == 'postgres'
+        assert database.replica_connection is None
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_replicas_copy')
+        database.execute('create table test_replicas_copy (id int)')
+    with Database(configuration) as database:
+        database.copy_in('test_replicas_copy', [{'id': 1}])
+        assert database.select('test_replicas_copy').execute().row_count() == 1
+    assert configuration.statistics()['pools']['replica_0']['idle'] == 1
+
+
+def test_result_cache():
+    configuration = Configuration(configuration_file='configuration.json')
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_cache')
+        database.execute('create table test_cache (id int primary key, description varchar(255))')
+        database.insert('test_cache').set('id', 1).set('description', 'Test 1').execute()
+    with Database(configuration) as database:
+        assert database.select('test_cache').where('id', 1).cache().execute().fetch_one().description == 'Test 1'
+        database.execute("update test_cache set description = 'Not invalidated'")
+    with Database(configuration) as database:
+        data = database.select('test_cache').where('id', 1).cache().execute()
+        assert data.row_count() == 1
+        assert data.fetch_one().description == 'Test 1'
+        database.update('test_cache').set('description', 'New Test 1').where('id', 1).execute()
+        assert database.select('test_cache').where('id', 1).cache().execute().fetch_one().description == 'New Test 1'
+    with Database(configuration) as database:
+        assert database.select('test_cache').where('id', 1).cache(ttl=30).execute().fetch_one().description == 'New Test 1'
+        assert database.execute('select * from test_cache', cache=True, tags=['test_cache']).fetch_all()[0].id == 1
+    statistics = configuration.statistics()['result_cache']
+    assert statistics['hits'] == 1
+    assert statistics['misses'] == 3
+    assert statistics['invalidations'] == 1
+    assert statistics['entries'] == 2
+    with Database(configuration) as database:
+        database.copy_in('test_cache', [{'id': 2, 'description': 'Test 2'}])
+    with Database(configuration) as database:
+        assert len(database.execute('select * from test_cache', cache=True, tags=['test_cache']).fetch_all()) == 2
+        assert database.execute("select 'a  b' as description", cache=True).fetch_one().description == 'a  b'
+        assert database.execute("select 'a b' as description", cache=True).fetch_one().description == 'a b'
+
+
 def test_rollback():
     try:
         with Database() as database:
@@ -109,6 +508,272 @@ def test_rollback():
             assert database.select('test').where('id', 10).execute().fetch_one() is None
 
 
+def test_row_formats():
+    with Database() as database:
+        database.execute('drop table if exists test_row_formats')
+        database.execute("create table test_row_formats as select generate_series(1, 3) as id, 'Test' as description")
+        assert database.execute('select * from test_row_formats order by id', row_format='tuple').fetch_all() == [(1, 'Test'), (2, 'Test'), (3, 'Test')]
+        assert database.execute('select * from test_row_formats where id = 1', row_format='dict').fetch_one() == {'id': 1, 'description': 'Test'}
+        data = database.select('test_row_formats').fields('id', 'count(*)').group_by('id').order_by('id').row_format('record').execute().fetch_all()
+        assert [(row.id, row.count) for row in data] == [(1, 1), (2, 1), (3, 1)]
+        assert [row.id for row in database.select('test_row_formats').order_by('id').row_format('record').stream(chunk_size=2)] == [1, 2, 3]
+        assert database.select('test_row_formats').where('id', 1).cache().row_format('tuple').execute().fetch_one() == (1, 'Test')
+        assert database.select('test_row_formats').where('id', 1).cache().execute().fetch_one().description == 'Test'
+        try:
+            database.execute('select 1', row_format='list')
+            assert False
+        except ValueError:
+            pass
+
+
+def test_scan():
+    with Database() as database:
+        database.execute('drop table if exists test_scan')
+        database.execute('create table test_scan (id int primary key, value int)')
+        database.execute('insert into test_scan select index, index * 2 from generate_series(1, 10000) as index')
+    with Database() as database:
+        select = database.select('test_scan').where('value', 10000, operator='<=')
+        assert sorted(row.id for row in select.scan(partitions=4, chunk_size=100)) == list(range(1, 5001))
+        assert [row.id for row in select.scan(partitions=3, key='id', ordered=True, chunk_size=100)] == list(range(1, 5001))
+        assert list(database.select('test_scan t').where('t.id', 0).scan(key='t.id')) == []
+        scan = database.select('test_scan').row_format('tuple').scan(key='id', ordered=True, function=sum, processes=2)
+        assert list(scan) == [index * 3 for index in range(1, 10001)]
+        scan = database.select('test_scan').scan(partitions=4, chunk_size=10, queue_size=1)
+        next(scan)
+        scan.close()
+        with pytest.raises(ValueError):
+            database.select('test_scan').scan(key='id', partitions=0)
+    data = json.load(open('configuration.json'))
+    data['max_connection'] = 3
+    with Database(Configuration(configuration_dict=data)) as database:
+        assert sorted(row.id for row in database.select('test_scan').scan(partitions=8, key='id')) == list(range(1, 10001))
+        assert [row.id for row in database.select('test_scan').scan(partitions=8, key='id', ordered=True, chunk_size=100)] == list(range(1, 10001))
+    with Database() as database:
+        with pytest.raises(TypeError):
+            list(database.select('test_scan').scan(key='id', ordered=True, function=sum))
+        with pytest.raises(ValueError):
+            database.select('test_scan').fields('id').scan(key='value::text')
+
+
+def test_stream():
+    with Database() as database:
+        data = database.stream('select generate_series(1, 2500) as id', chunk_size=1000)
+        assert data.cursor.name is not None
+        assert sum(row.id for row in data) == 3126250
+        database.execute('drop table if exists test_stream')
+        database.execute('create table test_stream as select generate_series(0, 99) as id')
+        data = database.select('test_stream').where('id', 10, operator='<').order_by('id').stream(chunk_size=3)
+        assert [row.id for row in data] == list(range(10))
+        data = database.execute('select generate_series(1, 2500) as id')
+        assert next(data).id == 1
+        assert [row.id for row in data.fetch_many(2)] == [2, 3]
+        assert data.fetch_one().id == 4
+        assert [row.id for row in data.fetch_all()] == list(range(5, 2501))
+
+
+def test_sharded_database():
+    data = json.load(open('configuration.json'))
+    data.update({'shard_key': 'tenant_id', 'shards': [{'database': 'postgres'}, {'database': 'template1'}]})
+    configuration = Configuration(configuration_dict=data)
+    assert [shard.data['dbname'] for shard in configuration.shards] == ['postgres', 'template1']
+    with ShardedDatabase(configuration) as database:
+        database.scatter('create temporary table test_shards (id int, tenant_id int, name text)')
+        tenants = {database.shard_index(tenant): tenant for tenant in range(10)}
+        assert sorted(tenants.keys()) == [0, 1]
+        database.insert('test_shards').set('id', 1).set('tenant_id', tenants[0]).set('name', 'a').execute()
+        result = database.insert('test_shards').rows([
+            {'id': 2, 'tenant_id': tenants[1], 'name': 'b'},
+            {'id': 3, 'tenant_id': tenants[0], 'name': 'c'},
+            {'id': 4, 'tenant_id': tenants[1], 'name': 'd'}
+        ]).execute()
+        assert result.row_count() == 3
+        assert database.shard(tenants[1]).execute('select count(*) as total from test_shards').fetch_one().total == 2
+        assert database.select('test_shards').fields('current_database() as name').where('tenant_id', tenants[1]).execute().fetch_one().name == 'template1'
+        assert database.execute('select name from test_shards where tenant_id = %(tenant_id)s order by id', {'tenant_id': tenants[0]}).fetch_all() == [{'name': 'a'}, {'name': 'c'}]
+        assert [row.id for row in database.select('test_shards').order_by('id desc').execute().fetch_all()] == [4, 3, 2, 1]
+        assert database.execute('select id from test_shards', row_format='tuple').row_count() == 4
+        page = database.select('test_shards').order_by('id').paging(1, 2, count='exact')
+        assert [row.id for row in page.data] == [3, 4] and page.last and page.total == 4
+        page = database.select('test_shards').order_by('id').paging(0, 3, keyset=True)
+        assert [row.id for row in page.data] == [1, 2, 3] and not page.last
+        page = database.paging('select id from test_shards', 0, size=3, order_by=['id'], cursor=page.cursor)
+        assert [row.id for row in page.data] == [4] and page.last
+        page = database.select('test_shards').where('tenant_id', tenants[0]).order_by('id').paging(1, 1, count='exact')
+        assert [row.id for row in page.data] == [3] and page.total == 2
+        assert database.update('test_shards').set('name', 'e').where('tenant_id', tenants[1]).where('id', 2).execute().row_count() == 1
+        with pytest.raises(ValueError):
+            database.update('test_shards').set('name', 'e').where('id', 2).execute()
+        with pytest.raises(ValueError):
+            database.execute('delete from test_shards')
+        assert database.scatter('delete from test_shards where id > 2').row_count() == 2
+        assert [row.name for row in database.select('test_shards').order_by('id').execute().fetch_all()] == ['a', 'e']
+
+
+def test_slow_query_log(caplog):
+    data = json.load(open('configuration.json'))
+    data.update({'slow_query_ms': 50, 'slow_query_explain': True, 'slow_query_sample_rate': 0})
+    configuration = Configuration(configuration_dict=data)
+    with caplog.at_level(logging.WARNING, logger='py_postgresql_wrapper'):
+        with Database(configuration) as database:
+            database.execute('select pg_sleep(0.01)')
+            for _ in range(2):
+                database.execute('select pg_sleep(%(duration)s)', {'duration': 0.06})
+        configuration.slow_query_log.thread.join()
+    messages = [record.getMessage() for record in caplog.records]
+    assert len(messages) == 2
+    assert 'select pg_sleep(%(duration)s) - Parameters: {\'duration\': \'<redacted>\'}' in messages[0]
+    assert 'Buffers' in messages[1] or 'actual time' in messages[1]
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_slow_query')
+        database.execute('create table test_slow_query (id serial primary key, value int)')
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='py_postgresql_wrapper'):
+        with Database(configuration) as database:
+            database.execute('insert into test_slow_query (value) select 1 from pg_sleep(%(duration)s)', {'duration': 0.06})
+        configuration.slow_query_log.thread.join()
+    messages = [record.getMessage() for record in caplog.records]
+    assert 'plan' in messages[1] and 'actual time' not in messages[1]
+    with Database(configuration) as database:
+        assert database.execute("select nextval('test_slow_query_id_seq') as id").fetch_one().id == 2
+
+
+def test_statistics():
+    configuration = Configuration(configuration_file='configuration.json')
+    events = []
+    configuration.instrumentation.subscribe(events.append)
+    with Database(configuration) as database:
+        database.execute('find_test_by_id', {'id': 1})
+        database.select('test').where('id', 1).execute()
+        try:
+            database.execute('select * from test_not_found')
+        except Exception:
+            pass
+    statistics = configuration.statistics()
+    assert statistics['checkouts']['count'] == 1
+    assert statistics['errors'] == 1
+    assert statistics['pools']['primary']['idle'] == 1
+    assert statistics['queries']['find_test_by_id']['latency']['count'] == 1
+    assert statistics['queries']['select * from test where id = %(id)s']['latency']['p99'] is not None
+    assert statistics['queries']['select * from test_not_found']['errors'] == 1
+    assert [event['type'] for event in events] == ['checkout', 'query', 'query', 'query']
+
+    def fail(event):
+        raise RuntimeError('Callback failed')
+
+    configuration.instrumentation.subscribe(fail)
+    with Database(configuration) as database:
+        assert database.execute('select 1 as value').fetch_one().value == 1
+        with pytest.raises(Exception) as exception:
+            database.execute('select * from test_not_found')
+        assert exception.value.pgcode == '42P01'
+
+
+def test_subscription():
+    configuration = Configuration(configuration_file='configuration.json')
+    reconnected = []
+    with Database(configuration) as database:
+        database.execute('drop table if exists test_subscription')
+        database.execute('create table test_subscription (id int primary key)')
+    with Database(configuration).listen('test_subscription', reconnect_delay=0.1, on_reconnect=reconnected.append) as subscription:
+        with Database(configuration) as database:
+            database.insert('test_subscription').set('id', 1).notify('test_subscription', {'id': 1}).execute()
+            assert subscription.get(0.1) is None
+        notification = subscription.get(5)
+        assert (notification.channel, json.loads(notification.payload)) == ('test_subscription', {'id': 1})
+        with Database(configuration) as database:
+            for index in range(5):
+                database.notify('test_subscription', index)
+        assert [notification.payload for notification in next(subscription.batches(0.2))] == ['0', '1', '2', '3', '4']
+        with Database(configuration, deferred=True) as database:
+            database.insert('test_subscription').set('id', 2).notify('test_subscription', 'inserted').execute()
+            database.delete('test_subscription').where('id', 2).notify('test_subscription', 'deleted').execute()
+            assert len(database.deferred_statements) == 2
+        assert [notification.payload for notification in next(subscription.batches(0.2))] == ['inserted', 'deleted']
+        with Database(configuration) as database:
+            database.execute('select pg_terminate_backend(%(pid)s)', {'pid': subscription.connection.get_backend_pid()})
+        assert subscription.get(1) is None
+        assert subscription.reconnects == 1 and reconnected == [subscription]
+        subscription.configuration = Configuration(configuration_dict=dict(json.load(open('configuration.json')), port=1))
+        with Database(configuration) as database:
+            database.execute('select pg_terminate_backend(%(pid)s)', {'pid': subscription.connection.get_backend_pid()})
+        start = time.monotonic()
+        assert subscription.get(0.5) is None
+        subscription.listen('test_subscription_down').unlisten('test_subscription_down')
+        assert time.monotonic() - start < 1
+        subscription.configuration = configuration
+        assert subscription.get(1) is None
+        assert subscription.reconnects == 2
+        notifications = []
+        subscription.start(notifications.append)
+        with Database(configuration) as database:
+            database.notify('test_subscription', 'after reconnect')
+        deadline = time.monotonic() + 5
+        while len(notifications) == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [notification.payload for notification in notifications] == ['after reconnect']
+        start = time.monotonic()
+        subscription.listen('test_subscription_other')
+        assert time.monotonic() - start < 1
+        with Database(configuration) as database:
+            database.notify('test_subscription_other', 'other')
+        deadline = time.monotonic() + 5
+        while len(notifications) == 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [notification.channel for notification in notifications] == ['test_subscription', 'test_subscription_other']
+
+    async def test():
+        async with AsyncDatabase(configuration).listen('test_subscription') as subscription:
+            async with AsyncDatabase(configuration) as database:
+                await database.delete('test_subscription').where('id', 1).notify('test_subscription', 'deleted').execute()
+            notification = await subscription.get(5)
+            assert notification.payload == 'deleted'
+            async with AsyncDatabase(configuration) as database:
+                for index in range(3):
+                    await database.notify('test_subscription', index)
+            assert [notification.payload for notification in await anext(subscription.batches(0.2))] == ['0', '1', '2']
+
+    asyncio.run(test())
+
+
+def test_timeout():
+    data = json.load(open('configuration.json'))
+    data.update({'max_connection': 2, 'pool_timeout': 0.2})
+    configuration = Configuration(configuration_dict=data)
+    start = time.perf_counter()
+    with pytest.raises(QueryTimeoutException):
+        with Database(configuration) as database:
+            assert database.execute('select pg_sleep(0.1) is null as slept', timeout=1).fetch_one().slept is False
+            database.execute('select pg_sleep(5)', timeout=0.2)
+    assert time.perf_counter() - start < 1
+    with Database(configuration) as database:
+        assert database.execute('show statement_timeout').fetch_one().statement_timeout == '0'
+        with pytest.raises(PoolTimeoutException):
+            with Database(configuration) as other, Database(configuration) as another:
+                other.execute('select 1')
+                another.execute('select 1')
+    start = time.perf_counter()
+    with pytest.raises(QueryTimeoutException):
+        with Database(configuration, timeout=0.5) as database:
+            database.execute('select pg_sleep(0.2)')
+            database.execute('select pg_sleep(5)')
+    assert time.perf_counter() - start < 0.8
+    with pytest.raises(QueryTimeoutException):
+        with Database(configuration) as database:
+            database.select('pg_database').fields('pg_sleep(5) is null').timeout(0.1).execute()
+    with pytest.raises(QueryTimeoutException):
+        with Database(configuration) as database:
+            database.paging('select pg_sleep(5) is null as slept', count='exact', timeout=0.1)
+    assert time.perf_counter() - start < 2
+
+    async def execute():
+        async with AsyncDatabase(configuration) as database:
+            await database.execute('select pg_sleep(5)', timeout=0.1)
+
+    with pytest.raises(QueryTimeoutException):
+        asyncio.run(execute())
+    assert time.perf_counter() - start < 3
+
+
 def test_truncate_table():
     with Database() as database:
         database.execute('''
@@ -122,9 +787,64 @@ def test_update():
         assert data.cursor.rowcount == 1
 
 
+def test_update_rows():
+    with Database() as database:
+        database.execute('drop table if exists test_update_rows')
+        database.execute('create table test_update_rows (id int primary key, description varchar(255), updated timestamp, version int)')
+        database.insert('test_update_rows').rows({'id': index, 'description': 'Test {}'.format(index), 'version': 0} for index in range(2500)).execute()
+        rows = ({'id': index, 'description': 'New Test {}'.format(index), 'updated': '2020-01-01 00:00:00'} for index in range(0, 2600, 2))
+        data = database.update('test_update_rows').set('description', None).set('updated', None).set('version', 'version + 1', constant=True).where('id', None).rows(rows, batch_size=500).execute()
+        assert data.counts == [500, 500, 250]
+        assert data.row_count() == 1250
+        data = database.select('test_update_rows').where('id', 2).execute().fetch_one()
+        assert (data.description, str(data.updated), data.version) == ('New Test 2', '2020-01-01 00:00:00', 1)
+        assert database.select('test_update_rows').where('id', 3).execute().fetch_one().version == 0
+        data = database.delete('test_update_rows').where('id', None).where('version', 1).rows({'id': index} for index in range(10)).execute()
+        assert data.row_count() == 5
+        data = database.update('test_update_rows').set('description', None).where('id', None).rows([{'id': 5, 'description': 7}]).execute()
+        assert data.counts == [1]
+        assert database.select('test_update_rows').where('id', 5).execute().fetch_one().description == '7'
+        data = database.update('test_update_rows u').set('version', None).where('u.id', None).rows([{'u.id': 5, 'version': 5}]).execute()
+        assert data.counts == [1]
+        data = database.delete('test_update_rows u').where('u.id', None).where('u.version', 5, constant=True).rows([{'u.id': 5}]).execute()
+        assert data.counts == [1]
+        try:
+            database.update('test_update_rows').set('description', None).where('version', 0, constant=True).rows([{'description': 'Test'}]).execute()
+            assert False
+        except ValueError:
+            pass
+    with pytest.raises(Exception) as exception:
+        with Database() as database:
+            database.update('test_update_rows').set('description', None).where('id', None).rows([{'id': 6, 'description': 'a' * 256}]).execute()
+    assert exception.value.pgcode == '22001'
+
+
 def test_update_where_all():
     try:
         with Database() as database:
             database.update('test').set('description', 'New Test 1').where_all({'id': 1, 'description': 'Test 1'}).execute()
     except() as e:
         assert e is None
+
+
+def test_upsert():
+    with Database() as database:
+        database.execute('drop table if exists test_upsert')
+        database.execute('create table test_upsert (id int primary key, description varchar(255), created timestamp not null default now())')
+        data = database.upsert('test_upsert', [{'id': index, 'description': 'Test {}'.format(index)} for index in range(10)], ('id',))
+        assert (data.inserted, data.updated) == (10, 0)
+        rows = ({'id': index, 'description': 'New Test {}'.format(index)} for index in range(5, 2005))
+        data = database.upsert('test_upsert', rows, ('id',), threshold=100)
+        assert (data.inserted, data.updated, data.row_count()) == (1995, 5, 2000)
+        assert database.select('test_upsert').where('id', 5).execute().fetch_one().description == 'New Test 5'
+        data = database.upsert('test_upsert', [{'id': 1, 'description': 'Skipped'}, {'id': 3000, 'description': 'Test'}], ('id',), update=[])
+        assert (data.inserted, data.updated) == (1, 0)
+        database.insert('test_upsert').set('id', 1).set('description', 'New Test 1').on_conflict('id').execute()
+        assert database.select('test_upsert').where('id', 1).execute().fetch_one().description == 'New Test 1'
+        database.execute('drop table if exists test_upsert_array')
+        database.execute('create table test_upsert_array (id int primary key, tags text[])')
+        tags = ['a', 'b "c"', 'd\\e,{f}', None]
+        for threshold in (10, 1):
+            database.upsert('test_upsert_array', [{'id': index, 'tags': tags} for index in range(2)], ('id',), threshold=threshold)
+            assert database.select('test_upsert_array').where('id', 1).execute().fetch_one().tags == tags
+            database.execute('delete from test_upsert_array')